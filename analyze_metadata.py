@@ -1,13 +1,79 @@
+import collections
+import concurrent.futures
 import csv
 import datetime
 import json
+import os
 import pathlib
 import pprint
+import re
+import sqlite3
+import struct
 import subprocess
 
-def analyze_movie(movie_path: pathlib.Path) -> dict:
+# 自作
+import mov_atoms
+import ser_file
+
+# 解析対象の動画の拡張子
+MOVIE_SUFFIXES = {".mov", ".mp4", ".avi", ".ser"}
+
+# 切り抜きツール自身の出力 (*_crop.avi, *_crop_t1.ser, 書き込み中の *.tmp.avi, 選別用の一時ファイル selected_*.ser)
+CROP_OUTPUT_PATTERN = re.compile(r"(_crop(_t\d+)?|\.tmp|^selected_.*)$")
+
+# 切り抜きツールが区間ごとの結果を置くディレクトリ
+CROP_PARTS_SUFFIX = "_crop_parts"
+
+# 自前のアトム解析で読む拡張子
+MOV_ATOM_SUFFIXES = {".mov", ".mp4", ".m4v"}
+
+def analyze_movie(movie_path: pathlib.Path, timeout=None) -> dict:
     """
     json_dataを返す
+    MOV / MP4 はファイルのアトムを直接読み、読めない場合やその他の形式は ffprobe で解析する
+    SER は ffprobe で読めないのでヘッダから作る
+    """
+    movie_path = pathlib.Path(movie_path)
+    if movie_path.suffix.lower() == ".ser":
+        return analyze_ser(movie_path)
+
+    if movie_path.suffix.lower() in MOV_ATOM_SUFFIXES:
+        try:
+            json_data = mov_atoms.read_movie_atoms(movie_path)
+            if json_data["streams"]:
+                return json_data
+        except (ValueError, struct.error, IndexError):
+            pass
+
+    return analyze_movie_ffprobe(movie_path, timeout)
+
+def analyze_ser(movie_path: pathlib.Path) -> dict:
+    """
+    SER のヘッダとタイムスタンプから ffprobe と同じ形の json_data を作る
+    """
+    reader = ser_file.SerReader(movie_path)
+    try:
+        stream = {
+            "index": 0,
+            "codec_type": "video",
+            "width": reader.width,
+            "height": reader.height,
+            "nb_frames": str(len(reader)),
+            "tags": {
+                # MOV と同じく、ローカル時間を Z 付きで入れる
+                "creation_time": reader.local_start_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            },
+        }
+        if reader.fps > 0:
+            stream["duration"] = "%.6f" % (len(reader) / reader.fps)
+        return {"streams": [stream]}
+    finally:
+        reader.close()
+
+def analyze_movie_ffprobe(movie_path: pathlib.Path, timeout=None) -> dict:
+    """
+    ffprobe で解析して json_dataを返す
+    timeout 秒以内に ffprobe が終わらなければ subprocess.TimeoutExpired
     """
     
     # 実行コマンド
@@ -20,11 +86,50 @@ def analyze_movie(movie_path: pathlib.Path) -> dict:
     ]
 
     # 解析実行
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True)
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True,timeout=timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip())
     json_data = json.loads(proc.stdout)
     
     return json_data
 
+def analyze_keyframes(movie_path: pathlib.Path) -> list:
+    """
+    映像ストリームのキーフレームのフレーム番号 (表示順) をリストで返す
+    """
+    
+    # 実行コマンド
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts,flags',
+        '-of', 'csv=p=0',
+        movie_path
+    ]
+
+    # 解析実行
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+
+    # パケットはデコード順なので、pts で並べ替えて表示順のフレーム番号にする
+    packets = []
+    for line in proc.stdout.splitlines():
+        pts, flags = line.split(",")[:2]
+        if pts in ("", "N/A"):
+            continue
+        packets.append((int(pts), "K" in flags))
+    packets.sort()
+
+    return [index for index, (pts, is_key) in enumerate(packets) if is_key]
+
+def main_stream(json_data: dict) -> dict:
+    """
+    撮影時刻・録画時間を読むストリーム
+    カメラの MOV は streams[1] を使い、ストリームが1つしかない動画 (AVI, SER など) は streams[0] を使う
+    """
+    streams = json_data["streams"]
+    return streams[1] if len(streams) > 1 else streams[0]
+
 def fetch_creation_time(json_data: dict) -> datetime.datetime:
     """
     録画開始時間をで返す
@@ -40,7 +145,10 @@ def fetch_creation_time(json_data: dict) -> datetime.datetime:
     """
     
     # 実データはローカル時間なので、タイムゾーン付与
-    s = json_data["streams"][1]["tags"]["creation_time"].replace("Z", "+09:00")
+    tags = main_stream(json_data).get("tags", {})
+    if "creation_time" not in tags:
+        tags = json_data["format"]["tags"]
+    s = tags["creation_time"].replace("Z", "+09:00")
     return datetime.datetime.fromisoformat(s)
 
 def test_fetch_creation_time():
@@ -49,7 +157,7 @@ def test_fetch_creation_time():
         print(fetch_creation_time(data))
 
 def fetch_duration_time(json_data: dict) -> float:
-    return float(json_data["streams"][1]["duration"])
+    return float(main_stream(json_data)["duration"])
 
 def test_fetch_play_time():
     with open("test_metadata.json", "r") as f:
@@ -67,11 +175,50 @@ def save_movie_metadata() -> None:
     with open(save_file, "w") as f:
         json.dump(data, f, indent=2)
 
-def glob_movies_list(movies_path: pathlib.Path) -> list:
+def is_crop_output(path: pathlib.Path) -> bool:
+    """
+    切り抜きツール自身が書き出したファイルなら True
+    """
+    return CROP_OUTPUT_PATTERN.search(path.stem) is not None or path.parent.name.endswith(CROP_PARTS_SUFFIX)
+
+def scan_movies(movies_path: pathlib.Path, suffixes=MOVIE_SUFFIXES, recursive=True, exclude_outputs=True):
+    """
+    拡張子が suffixes (小文字) のファイルを見つけた順に返すジェネレータ
+    ディレクトリごとに名前順で返し、recursive ならサブディレクトリもたどる
+    exclude_outputs なら切り抜きツール自身の出力 (is_crop_output) は返さない
+    読めないディレクトリは飛ばす
+    """
+    stack = [str(movies_path)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (exclude_outputs and entry.name.endswith(CROP_PARTS_SUFFIX)):
+                        subdirectories.append(entry.path)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in suffixes:
+                    path = pathlib.Path(entry.path)
+                    if not (exclude_outputs and is_crop_output(path)):
+                        yield path
+            except OSError:
+                continue
+
+        if recursive:
+            # 名前順にたどるため、逆順に積む
+            stack.extend(reversed(subdirectories))
+
+def glob_movies_list(movies_path: pathlib.Path, suffixes=MOVIE_SUFFIXES, recursive=True, exclude_outputs=True) -> list:
     """
     拡張子が動画のファイルをリストにして返す
     """
-    movies_list = list(movies_path.glob("*.MOV"))
+    movies_list = list(scan_movies(movies_path, suffixes, recursive, exclude_outputs))
     return movies_list
 
 def test_glob_movies_list():
@@ -79,26 +226,281 @@ def test_glob_movies_list():
     movies_path = pathlib.Path(movies_dir)
     pprint.pprint(glob_movies_list(movies_path))
 
-def save_movies_datetime(movies_path: pathlib.Path, save_path: pathlib.Path) -> None:
+# 撮影開始時刻の入っていない動画の error (ファイルが変わらなければ結果も変わらないので、カタログから返す)
+NO_CREATION_TIME_ERROR = "no creation_time"
+
+def analyze_movie_metadata(movie_path: pathlib.Path, timeout=None) -> dict:
     """
-    動画データのディレクトリを指定し、リストにまとめる
+    1つの動画を解析して CSV の1行分を返す (json_data には解析結果そのものを入れる)
+    失敗した場合は error にエラー内容を入れて返す
+    撮影開始時刻がなければ error を NO_CREATION_TIME_ERROR にして、録画時間は読む
+    """
+    metadata = {
+        "name": movie_path.name,
+        "creation_time": "",
+        "duration_time": "",
+        "error": "",
+        "json_data": None,
+    }
+    try:
+        data = analyze_movie(movie_path, timeout)
+        metadata["json_data"] = data
+        try:
+            metadata["creation_time"] = fetch_creation_time(data)
+        except KeyError:
+            metadata["error"] = NO_CREATION_TIME_ERROR
+        metadata["duration_time"] = fetch_duration_time(data)
+    except subprocess.TimeoutExpired:
+        metadata["error"] = "timeout"
+    except Exception as e:
+        metadata["error"] = repr(e)
+    return metadata
+
+# CSV の列
+METADATA_CSV_HEADER = ["name", "creation_time", "duration_time", "error"]
+
+class MetadataCatalog:
     """
-    metadata_list = list()
+    動画メタデータの SQLite カタログ
+
+    (パス, サイズ, 更新日時) をキーに ffprobe の解析結果 JSON と撮影開始時刻・録画時間を保存する
+    再スキャンでは新しいファイルと変更されたファイルだけを解析する
+    export_csv でカタログを metadata.csv と同じ形式で書き出せる
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS movies (
+            path TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            stream_json TEXT,
+            creation_time TEXT,
+            duration_time REAL,
+            error TEXT NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS movies_creation_time ON movies (creation_time);
+        CREATE INDEX IF NOT EXISTS movies_directory ON movies (directory);
+        CREATE VIEW IF NOT EXISTS metadata_csv AS
+            SELECT directory, name, creation_time, duration_time, error FROM movies;
+    """
+
+    def __init__(self, db_path: pathlib.Path) -> None:
+        self.db_path = db_path
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
 
-    for movie_path in glob_movies_list(movies_path):
-        data = analyze_movie(movie_path)
-        metadata = {
-            "name": movie_path.name,
-            "creation_time": fetch_creation_time(data),
-            "duration_time": fetch_duration_time(data),
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def movie_key(movie_path: pathlib.Path):
+        stat = movie_path.stat()
+        return str(movie_path.resolve()), stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, path, size, mtime_ns):
+        """
+        解析済みで変更のないファイルなら CSV の1行分を返す (なければ None)
+        前回解析に失敗したファイルは解析し直すため None (撮影開始時刻がないだけのファイルは解析し直さない)
+        """
+        row = self.conn.execute(
+            "SELECT name, creation_time, duration_time, error FROM movies "
+            "WHERE path = ? AND size = ? AND mtime_ns = ? AND error IN ('', ?)",
+            (path, size, mtime_ns, NO_CREATION_TIME_ERROR),
+        ).fetchone()
+        if row is None:
+            return None
+        name, creation_time, duration_time, error = row
+        return {
+            "name": name,
+            "creation_time": creation_time if creation_time is not None else "",
+            "duration_time": duration_time if duration_time is not None else "",
+            "error": error,
         }
-        metadata_list.append(metadata)
-    
-    with open(str(save_path), "w", newline="") as f:
-        header = ["name", "creation_time", "duration_time"]
-        writer = csv.DictWriter(f, header)
+
+    def iter_scan(self, movies_iter, max_workers=8, timeout=60):
+        """
+        movies_iter の動画を順に調べ、(パス, CSV の1行分) を movies_iter と同じ順に返すジェネレータ
+        変更のないファイルはカタログの内容を使い、それ以外はスレッドプールで解析する
+        解析結果は返すときに1件ずつカタログに保存するので、途中で止めても返した分は残る
+        順番待ちにするのは max_workers の2倍のファイルまでで、ファイル数によらずメモリは一定
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # (キー, CSV の1行分 または 解析中の future) の、movies_iter の順のキュー
+        pending = collections.deque()
+        try:
+            for movie_path in movies_iter:
+                key = self.movie_key(movie_path)
+                metadata = self.lookup(*key)
+                if metadata is None:
+                    metadata = executor.submit(analyze_movie_metadata, movie_path, timeout)
+                pending.append((key, metadata))
+
+                # 先頭から終わった分を返し、一杯なら先頭が終わるまで待つ
+                while pending and (len(pending) >= max_workers * 2 or self.is_ready(pending[0][1])):
+                    yield self.collect(*pending.popleft())
+
+            while pending:
+                yield self.collect(*pending.popleft())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def is_ready(metadata):
+        return not isinstance(metadata, concurrent.futures.Future) or metadata.done()
+
+    def collect(self, key, metadata):
+        """
+        解析の結果 (解析中なら終わるまで待つ) をカタログに保存して (パス, CSV の1行分) を返す
+        """
+        if isinstance(metadata, concurrent.futures.Future):
+            metadata = metadata.result()
+            self.upsert(key, metadata)
+            self.conn.commit()
+        return key[0], metadata
+
+    def upsert(self, key, metadata: dict):
+        path, size, mtime_ns = key
+        json_data = metadata["json_data"]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO movies (path, name, directory, size, mtime_ns, stream_json, creation_time, duration_time, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                metadata["name"],
+                str(pathlib.Path(path).parent),
+                size,
+                mtime_ns,
+                json.dumps(json_data) if json_data is not None else None,
+                str(metadata["creation_time"]) if metadata["creation_time"] != "" else None,
+                metadata["duration_time"] if metadata["duration_time"] != "" else None,
+                metadata["error"],
+            ),
+        )
+
+    def prune(self, movies_path: pathlib.Path, recursive=True, exclude_outputs=False):
+        """
+        movies_path (recursive ならその下も) にあったファイルのうち、もう存在しないファイルをカタログから消す
+        exclude_outputs なら切り抜きツール自身の出力 (is_crop_output) も消す
+        """
+        directory = str(movies_path.resolve())
+        if recursive:
+            rows = self.conn.execute("SELECT path FROM movies WHERE path LIKE ? ESCAPE '\\'", (like_prefix(directory),))
+        else:
+            rows = self.conn.execute("SELECT path FROM movies WHERE directory = ?", (directory,))
+        removed = [
+            path for (path,) in rows
+            if not os.path.exists(path) or (exclude_outputs and is_crop_output(pathlib.Path(path)))
+        ]
+        self.conn.executemany("DELETE FROM movies WHERE path = ?", [(path,) for path in removed])
+        self.conn.commit()
+
+    def query(self, target=None, date=None, min_duration=None, movies_path: pathlib.Path = None) -> list:
+        """
+        条件に合う動画を撮影開始時刻順に (パス, 撮影開始時刻, 録画時間) のリストで返す
+
+        target: パスに含まれる文字列 (対象ごとのディレクトリ名など。例: "Jupiter")
+        date: 撮影日 (datetime.date, creation_time と同じタイムゾーン)
+        min_duration: 録画時間の下限 [s]
+        movies_path: このディレクトリ以下に限る
+        """
+        sql = "SELECT path, creation_time, duration_time FROM movies WHERE error = ''"
+        params = []
+        if target is not None:
+            sql += " AND path LIKE ? ESCAPE '\\'"
+            params.append("%" + escape_like(target) + "%")
+        if date is not None:
+            # 文字列の範囲で検索し、インデックスを使う
+            sql += " AND creation_time >= ? AND creation_time < ?"
+            params.append(date.isoformat())
+            params.append((date + datetime.timedelta(days=1)).isoformat())
+        if min_duration is not None:
+            sql += " AND duration_time > ?"
+            params.append(min_duration)
+        if movies_path is not None:
+            sql += " AND path LIKE ? ESCAPE '\\'"
+            params.append(like_prefix(str(movies_path.resolve())))
+        sql += " ORDER BY creation_time"
+        return self.conn.execute(sql, params).fetchall()
+
+    def export_csv(self, save_path: pathlib.Path, movies_path: pathlib.Path = None, recursive=True, suffixes=None) -> None:
+        """
+        カタログを metadata.csv の形式でパスの順に書き出す
+        movies_path を指定すればそのディレクトリ (recursive ならその下も) のファイルのみで、name 列は movies_path からの相対パス
+        suffixes を指定すれば拡張子 (小文字) がそれに含まれるファイルのみ
+        """
+        sql = "SELECT directory, name, creation_time, duration_time, error FROM metadata_csv"
+        params = []
+        root = None
+        if movies_path is not None:
+            root = str(movies_path.resolve())
+            if recursive:
+                sql += " WHERE (directory = ? OR directory LIKE ? ESCAPE '\\')"
+                params += [root, like_prefix(root)]
+            else:
+                sql += " WHERE directory = ?"
+                params.append(root)
+        sql += " ORDER BY directory || ? || name"
+        params.append(os.sep)
+
+        with open(str(save_path), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(METADATA_CSV_HEADER)
+            for directory, name, creation_time, duration_time, error in self.conn.execute(sql, params):
+                if suffixes is not None and os.path.splitext(name)[1].lower() not in suffixes:
+                    continue
+                path = os.path.join(directory, name)
+                writer.writerow([
+                    os.path.relpath(path, root) if root is not None else name,
+                    creation_time if creation_time is not None else "",
+                    duration_time if duration_time is not None else "",
+                    error,
+                ])
+
+def escape_like(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def like_prefix(directory: str) -> str:
+    """
+    ディレクトリ以下のパスに一致する LIKE のパターン
+    """
+    return escape_like(directory.rstrip(os.sep) + os.sep) + "%"
+
+def save_movies_datetime(movies_path: pathlib.Path, save_path: pathlib.Path, max_workers=8, timeout=60, on_progress=None,
+                         catalog_path: pathlib.Path = None, suffixes=MOVIE_SUFFIXES, recursive=True, exclude_outputs=True) -> None:
+    """
+    動画データのディレクトリを指定し、リストにまとめる
+    サブディレクトリもたどり、切り抜きツール自身の出力は exclude_outputs なら除く
+    CSV には見つけた順 (ディレクトリごとに名前順) に、1ファイル終わるたびに1行書いてフラッシュする (中断しても途中までの CSV は残る)
+    name 列は movies_path からの相対パス
+    解析結果はカタログ (既定ではディレクトリ内の metadata.sqlite3) に保存し、変更のないファイルは解析し直さない
+    解析に失敗したファイルは error 列にエラー内容を書き、他のファイルは続けて解析する
+
+    on_progress: 1ファイル終わるたびに on_progress(終わった数, 行) を呼ぶ
+    """
+    if catalog_path is None:
+        catalog_path = movies_path / "metadata.sqlite3"
+    root = str(movies_path.resolve())
+
+    with MetadataCatalog(catalog_path) as catalog, open(str(save_path), "w", newline="") as f:
+        writer = csv.DictWriter(f, METADATA_CSV_HEADER, extrasaction="ignore")
         writer.writeheader()
-        writer.writerows(metadata_list)
+        f.flush()
+
+        movies_iter = scan_movies(movies_path, suffixes, recursive, exclude_outputs)
+        for done_count, (path, metadata) in enumerate(catalog.iter_scan(movies_iter, max_workers, timeout), 1):
+            writer.writerow(dict(metadata, name=os.path.relpath(path, root)))
+            f.flush()
+            if on_progress is not None:
+                on_progress(done_count, metadata)
+
+        catalog.prune(movies_path, recursive, exclude_outputs)
 
 def cui_main():
     movies_dir = r"./test_data/"
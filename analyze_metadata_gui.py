@@ -36,8 +36,20 @@ def main(page: ft.Page):
         try:
             movies_path = pathlib.Path(dir_path.value)
             save_path = movies_path / "metadata.csv"
-            my.save_movies_datetime(movies_path, save_path)
-            execute_status.value = "成功: %s" % (str(save_path))
+            error_count = 0
+
+            def on_progress(done_count, metadata):
+                nonlocal error_count
+                if metadata["error"]:
+                    error_count += 1
+                execute_status.value = "解析中 %d" % done_count
+                execute_status.update()
+
+            my.save_movies_datetime(movies_path, save_path, on_progress=on_progress)
+            if error_count == 0:
+                execute_status.value = "成功: %s" % (str(save_path))
+            else:
+                execute_status.value = "成功 (エラー %d件): %s" % (error_count, str(save_path))
             execute_status.update()
         except:
             traceback.print_exc()
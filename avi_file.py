@@ -0,0 +1,123 @@
+"""
+非圧縮 AVI(RAW) ファイル
+
+RIFF のチャンクをたどってフレームデータの位置を調べ、メモリマップで読み込む
+https://learn.microsoft.com/ja-jp/windows/win32/directshow/avi-riff-file-reference
+"""
+
+# 公式
+import pathlib
+import struct
+
+# サードパーティ
+import numpy as np
+
+# BITMAPINFOHEADER
+BITMAPINFOHEADER_FORMAT = "<IiiHHI"
+
+# 非圧縮とみなす biCompression (BI_RGB と非圧縮の FourCC)
+RAW_COMPRESSIONS = (0,) + tuple(struct.unpack("<I", fourcc)[0] for fourcc in (b"RAW ", b"DIB ", b"Y800", b"I420", b"IYUV"))
+
+class RawAviReader:
+    """
+    非圧縮 AVI をメモリマップで読み込む
+
+    reader[i] で i 番目のフレームを、ファイルを参照したままの配列 (コピーなし) で取得できる
+    対応する画素形式は BGR24 (ボトムアップ・トップダウン)、8bit グレー、I420 (Y プレーンのみ返す)
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.mmap = np.memmap(str(path), dtype=np.uint8, mode="r")
+        if self.mmap[0:4].tobytes() != b"RIFF" or self.mmap[8:12].tobytes() != b"AVI ":
+            raise ValueError("not an avi file: %s" % path)
+
+        self.fps = 0.0
+        self.width = None
+        self.height = None
+        self.bit_count = None
+        self.compression = None
+        self.bottom_up = False
+        # フレームデータの (位置, サイズ)
+        self.chunks = []
+
+        self.walk(0, self.mmap.size)
+        if self.width is None:
+            raise ValueError("video stream not found: %s" % path)
+
+        self.offsets = np.array([offset for offset, size in self.chunks], dtype=np.int64)
+        self.setup_layout()
+
+    def read_u32(self, offset):
+        return struct.unpack("<I", self.mmap[offset : offset + 4].tobytes())[0]
+
+    def walk(self, offset, end):
+        """
+        RIFF / LIST を再帰的にたどる (RIFF AVIX による 1GB 超のファイルも含む)
+        """
+        while offset + 8 <= end:
+            fourcc = self.mmap[offset : offset + 4].tobytes()
+            size = self.read_u32(offset + 4)
+            data = offset + 8
+
+            if fourcc in (b"RIFF", b"LIST"):
+                self.walk(data + 4, min(end, data + size))
+            elif fourcc == b"strh" and self.fps == 0.0:
+                if self.mmap[data : data + 4].tobytes() == b"vids":
+                    scale, rate = struct.unpack("<II", self.mmap[data + 20 : data + 28].tobytes())
+                    self.fps = rate / scale if scale else 0.0
+            elif fourcc == b"strf" and self.width is None:
+                header = struct.unpack(BITMAPINFOHEADER_FORMAT, self.mmap[data : data + 20].tobytes())
+                header_size, width, height, planes, self.bit_count, self.compression = header
+                self.width = width
+                self.height = abs(height)
+                # 高さが正ならボトムアップ
+                self.bottom_up = height > 0
+            elif fourcc[2:4] in (b"db", b"dc") and size != 0:
+                # 1本目の映像ストリームのフレーム
+                if fourcc[0:2] == b"00":
+                    self.chunks.append((data, size))
+
+            offset = data + size + (size & 1)
+
+    def setup_layout(self):
+        width, height = self.width, self.height
+        frame_size = self.chunks[0][1] if len(self.chunks) != 0 else 0
+
+        if self.compression not in RAW_COMPRESSIONS:
+            raise ValueError("compressed avi is not supported: %s" % self.path)
+
+        if self.bit_count == 24:
+            # 行は 4 byte 境界に揃う
+            self.stride = (width * 3 + 3) // 4 * 4
+            self.shape = (height, width, 3)
+        elif self.bit_count == 8:
+            self.stride = (width + 3) // 4 * 4
+            self.shape = (height, width)
+        elif frame_size == width * height * 3 // 2:
+            # I420 は Y プレーンのみ返す
+            self.stride = width
+            self.shape = (height, width)
+            self.bottom_up = False
+        else:
+            raise ValueError("unsupported pixel format: bit_count=%s" % self.bit_count)
+
+        if frame_size != 0 and frame_size < self.stride * height:
+            raise ValueError("frame size mismatch: %s" % self.path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        offset = int(self.offsets[index])
+        height = self.shape[0]
+        row_bytes = self.shape[1] * (self.shape[2] if len(self.shape) == 3 else 1)
+
+        rows = self.mmap[offset : offset + self.stride * height].reshape(height, self.stride)
+        frame = rows[:, :row_bytes].reshape(self.shape)
+        if self.bottom_up:
+            frame = frame[::-1]
+        return frame
+
+    def close(self):
+        self.offsets = None
+        self.mmap = None
@@ -0,0 +1,363 @@
+"""
+ベンチマーク
+
+合成した惑星動画 (ノイズのある背景の上を移動するぼけた円盤) で、
+クロッピングの各処理とメタデータ解析の速度 (フレーム/秒) とピークメモリを測り、JSON で出力する
+コミットごとの結果を比べて、速度の改善・悪化を確認するために使う
+
+python benchmark.py -o bench.json
+"""
+
+# 公式
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# サードパーティ
+import cv2
+import numpy as np
+
+# 自作
+import analyze_metadata
+import planetary_cropping as my
+import ser_file
+
+def make_planet_sprite(radius, blur):
+    """
+    半径 radius の円盤をガウシアンでぼかした画像 (0..1, float32) を作る
+    """
+    half = int(radius + blur * 3) + 1
+    y, x = np.mgrid[-half : half + 1, -half : half + 1]
+    disk = (np.hypot(x, y) <= radius).astype(np.float32)
+    if blur > 0:
+        disk = cv2.GaussianBlur(disk, (0, 0), blur)
+    return disk
+
+def generate_planet_frames(width=1920, height=1080, frames=300, radius=40, blur=4.0, brightness=200,
+                           drift=(1.5, 0.5), jitter=2.0, noise=8.0, dropout=0.02, seed=0):
+    """
+    合成した惑星動画のフレーム (BGR, uint8) を返すジェネレータ
+
+    drift: 1フレームあたりの移動量 (x, y) [px]
+    jitter: 大気のゆらぎによる位置の揺れ (標準偏差) [px]
+    noise: 背景ノイズ (標準偏差)
+    dropout: 惑星が写らない (雲などで隠れる) フレームの割合
+    """
+    rng = np.random.default_rng(seed)
+    sprite = make_planet_sprite(radius, blur) * brightness
+    half = sprite.shape[0] // 2
+
+    # 背景は同じ大きさのノイズを使い回し、フレームごとにずらして変化させる
+    background = np.clip(rng.normal(16, noise, (height * 2, width)), 0, 255).astype(np.uint8)
+
+    x, y = width / 2 - drift[0] * frames / 2, height / 2 - drift[1] * frames / 2
+    for index in range(frames):
+        offset = int(rng.integers(0, height))
+        gray = background[offset : offset + height].astype(np.float32)
+
+        if rng.random() >= dropout:
+            cx = int(round(x + rng.normal(0, jitter)))
+            cy = int(round(y + rng.normal(0, jitter)))
+            # 画面からはみ出す部分は切り捨てる
+            x1, x2 = max(cx - half, 0), min(cx + half + 1, width)
+            y1, y2 = max(cy - half, 0), min(cy + half + 1, height)
+            if x1 < x2 and y1 < y2:
+                gray[y1 : y2, x1 : x2] += sprite[y1 - (cy - half) : y2 - (cy - half), x1 - (cx - half) : x2 - (cx - half)]
+
+        x += drift[0]
+        y += drift[1]
+
+        gray = np.clip(gray, 0, 255).astype(np.uint8)
+        yield cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+def generate_planet_movie(path: pathlib.Path, fps=30.0, fourcc="MJPG", **options):
+    """
+    合成した惑星動画を path に保存する
+    options は generate_planet_frames に渡す
+    """
+    width = options.get("width", 1920)
+    height = options.get("height", 1080)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError("outmovie error: %s" % path)
+    try:
+        for frame in generate_planet_frames(**options):
+            writer.write(frame)
+    finally:
+        writer.release()
+
+def generate_planet_ser(path: pathlib.Path, fps=30.0, **options):
+    """
+    合成した惑星動画を SER (MONO8) で保存する
+    """
+    width = options.get("width", 1920)
+    height = options.get("height", 1080)
+    start_time = datetime.datetime.now().astimezone()
+    writer = ser_file.SerWriter(path, width, height, "mono8", start_time)
+    try:
+        for index, frame in enumerate(generate_planet_frames(**options)):
+            writer.write(frame, start_time + datetime.timedelta(seconds=index / fps))
+    finally:
+        writer.release()
+
+def max_rss_bytes():
+    """
+    このプロセスの最大常駐メモリ (RSS) [bytes] (resource のない環境では None)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS は bytes、Linux は KiB
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def measure_peak_rss(func):
+    """
+    func() を fork した子プロセスで実行し、実行前からの最大常駐メモリ (RSS) の増分 [bytes] を返す
+    OpenCV や NumPy のネイティブのバッファも含む
+    最大 RSS はプロセスで戻せないので、計測ごとに子プロセスを作る (fork できない環境では None)
+    """
+    if "fork" not in multiprocessing.get_all_start_methods() or max_rss_bytes() is None:
+        return None
+
+    def run(conn):
+        before = max_rss_bytes()
+        func()
+        conn.send(max_rss_bytes() - before)
+
+    context = multiprocessing.get_context("fork")
+    reader, writer = context.Pipe(duplex=False)
+    process = context.Process(target=run, args=(writer,))
+    process.start()
+    writer.close()
+    try:
+        peak = reader.recv()
+    except EOFError:
+        peak = None
+    process.join()
+    if peak is None:
+        raise RuntimeError("メモリの計測に失敗しました (終了コード %s)" % process.exitcode)
+    return peak
+
+def measure(name, func, frames, repeat=1, unit="frames"):
+    """
+    func() を repeat 回実行し、最速の時間から求めたフレーム/秒と、ピークメモリを返す
+    frames は1回で処理する数 (unit がその単位。メタデータ解析はファイル数)
+    ピークメモリは別の実行で測る (measure_peak_rss を参照)
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    peak = measure_peak_rss(func)
+
+    seconds = min(times)
+    result = {
+        "name": name,
+        "frames": frames,
+        "unit": unit,
+        "seconds": seconds,
+        "fps": frames / seconds if seconds > 0 else None,
+        "peak_memory_bytes": peak,
+    }
+    print("%-24s %10.1f /s  %8.3f s  peak %7.1f MB" % (name, result["fps"] or 0, seconds, (peak or 0) / 2 ** 20),
+          file=sys.stderr)
+    return result
+
+def bench_stages(frames, crop_size, repeat):
+    """
+    preprocess, calc_moment, calc_projection_moment, calc_crop_range を、メモリ上のフレームで測る
+    """
+    height, width = frames[0].shape[:2]
+    grey_frames = [my.preprocess(frame) for frame in frames]
+    # 惑星が写っているフレームだけ重心を計算する
+    planet_frames = [grey for grey in grey_frames if my.exists_planets(grey)]
+    moments = [my.calc_moment(grey) for grey in planet_frames]
+
+    def run_preprocess():
+        for frame in frames:
+            my.preprocess(frame)
+
+    def run_calc_moment():
+        for grey in planet_frames:
+            my.calc_moment(grey)
+
+    def run_calc_projection_moment():
+        for grey in planet_frames:
+            my.calc_projection_moment(grey)
+
+    def run_calc_crop_range():
+        for x, y in moments:
+            my.calc_crop_range(width, height, x, y, crop_size)
+
+    return [
+        measure("preprocess", run_preprocess, len(frames), repeat),
+        measure("calc_moment", run_calc_moment, len(planet_frames), repeat),
+        measure("calc_projection_moment", run_calc_projection_moment, len(planet_frames), repeat),
+        measure("calc_crop_range", run_calc_crop_range, len(moments), repeat),
+    ]
+
+def bench_main_cropping(movie_path: pathlib.Path, frame_count, crop_size, repeat, detectors, threaded, decoder="opencv"):
+    """
+    main_cropping を検出方式ごとに測る
+    最後の実行の処理ごとの時間 (CropStats) も結果に入れる
+    """
+    results = []
+    for detector in detectors:
+        summaries = []
+
+        def run():
+            summaries.append(my.main_cropping(movie_path, crop_size, threaded=threaded, detector=detector, use_track=False,
+                                              on_progress=lambda stats: None, decoder=decoder))
+        result = measure("main_cropping[%s]" % detector, run, frame_count, repeat)
+        result["summary"] = summaries[-1]
+        results.append(result)
+    return results
+
+def bench_metadata_scan(movies_path: pathlib.Path, repeat):
+    """
+    メタデータ解析を、カタログなし (全ファイル解析) とカタログあり (変更なし) で測る
+    """
+    movie_count = len(analyze_metadata.glob_movies_list(movies_path))
+    catalog_path = movies_path / "metadata.sqlite3"
+    save_path = movies_path / "metadata.csv"
+
+    def run_cold():
+        if catalog_path.exists():
+            catalog_path.unlink()
+        analyze_metadata.save_movies_datetime(movies_path, save_path, catalog_path=catalog_path)
+
+    def run_warm():
+        analyze_metadata.save_movies_datetime(movies_path, save_path, catalog_path=catalog_path)
+
+    return [
+        measure("metadata_scan[cold]", run_cold, movie_count, repeat, "files"),
+        measure("metadata_scan[warm]", run_warm, movie_count, repeat, "files"),
+    ]
+
+def git_revision():
+    """
+    このファイルのあるリポジトリのコミットハッシュ (取得できなければ None) と、未コミットの変更があるか
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status.strip() != ""
+
+def run_benchmarks(args, work_path: pathlib.Path) -> dict:
+    options = {
+        "width": args.width,
+        "height": args.height,
+        "frames": args.frames,
+        "radius": args.radius,
+        "drift": (args.drift_x, args.drift_y),
+        "jitter": args.jitter,
+        "noise": args.noise,
+        "dropout": args.dropout,
+        "seed": args.seed,
+    }
+
+    # 合成動画
+    movie_path = work_path / "synthetic.avi"
+    generate_planet_movie(movie_path, args.fps, **options)
+
+    results = []
+    # 各処理 (デコード済みのフレームで測る)
+    frames = list(generate_planet_frames(**dict(options, frames=min(args.frames, args.stage_frames))))
+    results += bench_stages(frames, args.crop_size, args.repeat)
+    del frames
+
+    # 切り抜き全体 (デコード・検出・書き出し)
+    results += bench_main_cropping(movie_path, args.frames, args.crop_size, args.repeat, args.detectors, not args.no_threaded,
+                                   args.decoder)
+
+    # メタデータ解析
+    movies_path = work_path / "movies"
+    for i in range(args.scan_files):
+        directory = movies_path / ("%02d" % (i % 4))
+        directory.mkdir(parents=True, exist_ok=True)
+        if i % 2 == 0:
+            generate_planet_movie(directory / ("%04d.mp4" % i), args.fps, fourcc="mp4v",
+                                  **dict(options, width=160, height=120, frames=5, radius=8, seed=i))
+        else:
+            generate_planet_ser(directory / ("%04d.ser" % i), args.fps,
+                                **dict(options, width=160, height=120, frames=5, radius=8, seed=i))
+    results += bench_metadata_scan(movies_path, args.repeat)
+
+    commit, dirty = git_revision()
+    return {
+        "git_commit": commit,
+        "git_dirty": dirty,
+        "timestamp": datetime.datetime.now().astimezone().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": dict(vars(args), output=None),
+        "results": results,
+    }
+
+def cui_main():
+    parser = argparse.ArgumentParser(description="合成した惑星動画によるベンチマーク")
+    parser.add_argument("-o", "--output", default=None, help="結果の JSON を保存するファイル (省略時は標準出力)")
+    parser.add_argument("--width", type=int, default=1920, help="合成動画の幅")
+    parser.add_argument("--height", type=int, default=1080, help="合成動画の高さ")
+    parser.add_argument("--fps", type=float, default=30.0, help="合成動画のフレームレート")
+    parser.add_argument("--frames", type=int, default=300, help="合成動画のフレーム数")
+    parser.add_argument("--radius", type=int, default=40, help="惑星の半径 [px]")
+    parser.add_argument("--drift-x", type=float, default=1.5, help="1フレームあたりの横方向の移動量 [px]")
+    parser.add_argument("--drift-y", type=float, default=0.5, help="1フレームあたりの縦方向の移動量 [px]")
+    parser.add_argument("--jitter", type=float, default=2.0, help="位置の揺れ (標準偏差) [px]")
+    parser.add_argument("--noise", type=float, default=8.0, help="背景ノイズ (標準偏差)")
+    parser.add_argument("--dropout", type=float, default=0.02, help="惑星が写らないフレームの割合")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("-s", "--crop-size", type=int, default=384, help="切り抜きサイズ")
+    parser.add_argument("--detectors", nargs="+", choices=my.DETECTOR_INTERVALS.keys(), default=["full"],
+                        help="main_cropping を測る検出方式")
+    parser.add_argument("--decoder", choices=my.DECODERS, default="opencv", help="main_cropping のデコーダ")
+    parser.add_argument("--no-threaded", action="store_true", help="main_cropping をスレッドのステージなしで実行する")
+    parser.add_argument("--stage-frames", type=int, default=100, help="各処理の計測に使うフレーム数")
+    parser.add_argument("--scan-files", type=int, default=200, help="メタデータ解析の計測に使うファイル数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数 (最速の結果を使う)")
+    parser.add_argument("--workdir", default=None, help="合成動画を置くディレクトリ (省略時は一時ディレクトリ)")
+    args = parser.parse_args()
+
+    if args.workdir is None:
+        work_dir = tempfile.mkdtemp(prefix="planetary_bench_")
+    else:
+        work_dir = args.workdir
+        os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        report = run_benchmarks(args, pathlib.Path(work_dir))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    cui_main()
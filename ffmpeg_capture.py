@@ -0,0 +1,206 @@
+"""
+ffmpeg のサブプロセスでデコードする動画の読み込み
+
+ffmpeg のマルチスレッドのデコーダでデコードし、rawvideo をパイプで受け取る
+パイプからは readinto で NumPy の配列に直接読み込むので、余計なコピーはしない
+cv2.VideoCapture と同じ使い方 (isOpened, read, get, release) ができる
+"""
+
+# 公式
+import pathlib
+import shutil
+import subprocess
+import tempfile
+
+# サードパーティ
+import cv2
+import numpy as np
+
+# 出力する画素形式ごとの1画素あたりのバイト数
+PIX_FMT_BYTES = {
+    "gray": 1,
+    "bgr24": 3,
+    "yuvj420p": 1.5,
+}
+
+class I420Frame:
+    """
+    YUV420 (I420, フルレンジ) のフレーム
+
+    y は輝度 (H, W) の画像で、検出にはこれをそのまま使う
+    (フルレンジなので、BGR からグレースケール化した画像とほぼ同じになる)
+    BGR への変換は、切り抜く範囲だけ to_bgr で行う
+    """
+    def __init__(self, data, width, height) -> None:
+        # (H * 3 / 2, W) のバッファ (Y, U, V の順)
+        self.data = data
+        self.width = width
+        self.height = height
+        flat = data.reshape(-1)
+        y_size = width * height
+        c_size = y_size // 4
+        self.y = flat[:y_size].reshape(height, width)
+        self.u = flat[y_size : y_size + c_size].reshape(height // 2, width // 2)
+        self.v = flat[y_size + c_size : y_size + c_size * 2].reshape(height // 2, width // 2)
+
+    @property
+    def shape(self):
+        return (self.height, self.width, 3)
+
+    def to_bgr(self, x1, x2, y1, y2):
+        """
+        [y1:y2, x1:x2] の範囲だけ BGR に変換して返す
+        色差は 2x2 画素ごとなので、偶数の境界に広げて変換してから切り出す
+        フルレンジの変換式は JPEG と同じなので、OpenCV の YCrCb からの変換を使う
+        """
+        ex1, ey1 = x1 & ~1, y1 & ~1
+        ex2, ey2 = min(x2 + (x2 & 1), self.width), min(y2 + (y2 & 1), self.height)
+        w, h = ex2 - ex1, ey2 - ey1
+
+        # 色差を輝度と同じ大きさに広げて、範囲の YCrCb 画像を作る
+        cr = cv2.resize(self.v[ey1 // 2 : ey2 // 2, ex1 // 2 : ex2 // 2], (w, h), interpolation=cv2.INTER_NEAREST)
+        cb = cv2.resize(self.u[ey1 // 2 : ey2 // 2, ex1 // 2 : ex2 // 2], (w, h), interpolation=cv2.INTER_NEAREST)
+        ycrcb = cv2.merge([self.y[ey1 : ey2, ex1 : ex2], cr, cb])
+        bgr = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+        return bgr[y1 - ey1 : y2 - ey1, x1 - ex1 : x2 - ex1]
+
+class FfmpegError(IOError):
+    """
+    ffmpeg が異常終了した (デコードに失敗した)
+    """
+
+def ffmpeg_available() -> bool:
+    """
+    ffmpeg が PATH にあるか
+    """
+    return shutil.which("ffmpeg") is not None
+
+class FfmpegCapture:
+    """
+    ffmpeg で動画をデコードし、フレームを NumPy の配列で返す
+
+    pix_fmt: "bgr24" (カラー, cv2.VideoCapture と同じ), "gray" (輝度のみ)
+             または "yuvj420p" (I420Frame を返す。輝度で検出し、切り抜く範囲だけ BGR に変換するとき用)
+    threads: ffmpeg のデコードスレッド数 (0 なら自動)
+    start_frame: 最初に返すフレームの番号 (0 以外なら、その時刻まで -ss でシークしてからデコードする)
+    幅・高さ・フレームレート・フレーム数は cv2.VideoCapture でヘッダから読む
+    ffmpeg が異常終了した場合は、最後まで読んだところで read が FfmpegError を送出する
+    """
+    def __init__(self, path: pathlib.Path, pix_fmt="bgr24", threads=0, start_frame=0) -> None:
+        if pix_fmt not in PIX_FMT_BYTES:
+            raise ValueError("unknown pix_fmt: %s" % pix_fmt)
+
+        self.path = path
+        self.pix_fmt = pix_fmt
+        self.proc = None
+        # 終了時の ffmpeg のエラー出力
+        self.error = ""
+        self.props = dict()
+
+        # 動画の情報
+        capture = cv2.VideoCapture(str(path))
+        try:
+            if not capture.isOpened():
+                return
+            self.props = {
+                cv2.CAP_PROP_FRAME_WIDTH: capture.get(cv2.CAP_PROP_FRAME_WIDTH),
+                cv2.CAP_PROP_FRAME_HEIGHT: capture.get(cv2.CAP_PROP_FRAME_HEIGHT),
+                cv2.CAP_PROP_FPS: capture.get(cv2.CAP_PROP_FPS),
+                cv2.CAP_PROP_FRAME_COUNT: capture.get(cv2.CAP_PROP_FRAME_COUNT),
+            }
+        finally:
+            capture.release()
+
+        self.width = width = int(self.props[cv2.CAP_PROP_FRAME_WIDTH])
+        self.height = height = int(self.props[cv2.CAP_PROP_FRAME_HEIGHT])
+        if pix_fmt == "gray":
+            self.shape = (height, width)
+        elif pix_fmt == "bgr24":
+            self.shape = (height, width, 3)
+        else:
+            if width % 2 != 0 or height % 2 != 0:
+                raise ValueError("yuvj420p needs even frame size: %dx%d" % (width, height))
+            self.shape = (height * 3 // 2, width)
+        self.frame_size = int(width * height * PIX_FMT_BYTES[pix_fmt])
+
+        cmd = [
+            "ffmpeg",
+            "-v", "error",
+            "-nostdin",
+            "-threads", str(threads),
+        ]
+        fps = self.props[cv2.CAP_PROP_FPS]
+        if start_frame > 0 and fps > 0:
+            # 入力側のシーク (直前のキーフレームからデコードし、指定時刻より前のフレームは捨てる)
+            cmd += ["-ss", "%.6f" % (start_frame / fps)]
+        cmd += [
+            "-i", str(path),
+            "-map", "0:v:0",
+            "-f", "rawvideo",
+            "-pix_fmt", pix_fmt,
+            "-",
+        ]
+        # エラー出力は一時ファイルに書かせ、終了時に読む
+        # (パイプだと読まないうちに一杯になって ffmpeg が止まることがある)
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=self.stderr, bufsize=0)
+        except:
+            self.stderr.close()
+            raise
+
+    def isOpened(self):
+        return self.proc is not None and not self.proc.stdout.closed
+
+    def get(self, prop):
+        return self.props.get(prop, 0.0)
+
+    def read(self):
+        """
+        次のフレームを (成功したか, フレーム) で返す
+        yuvj420p の場合、フレームは I420Frame
+        ffmpeg が異常終了していた場合は、最後まで読んだところで FfmpegError
+        """
+        if not self.isOpened():
+            return False, None
+
+        frame = np.empty(self.shape, np.uint8)
+        buffer = memoryview(frame).cast("B")
+        filled = 0
+        while filled < self.frame_size:
+            n = self.proc.stdout.readinto(buffer[filled:])
+            if not n:
+                # 終了 (途中までのフレームは捨てる)
+                self.finish()
+                return False, None
+            filled += n
+
+        if self.pix_fmt == "yuvj420p":
+            return True, I420Frame(frame, self.width, self.height)
+        return True, frame
+
+    def finish(self):
+        """
+        出力を最後まで読んだ ffmpeg の終了を待ち、異常終了なら FfmpegError
+        """
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        self.read_error()
+        if returncode != 0:
+            raise FfmpegError("ffmpeg failed (exit code %d): %s: %s" % (returncode, self.path, self.error))
+
+    def read_error(self):
+        self.stderr.seek(0)
+        self.error = self.stderr.read().decode(errors="replace").strip()
+        self.stderr.close()
+
+    def release(self):
+        """
+        ffmpeg を止める (こちらから止めるので、終了コードは見ない)
+        """
+        if self.proc is None or self.proc.stdout.closed:
+            return
+        self.proc.stdout.close()
+        self.proc.terminate()
+        self.proc.wait()
+        self.read_error()
@@ -0,0 +1,173 @@
+"""
+MOV / MP4 (ISO BMFF) のアトムを読んでメタデータを取り出す
+
+ffprobe を起動せずに、moov 内の mvhd, tkhd, mdhd, hdlr だけをシークしながら読む
+結果は ffprobe -show_streams -of json と同じ形の dict で返す (必要なフィールドのみ)
+"""
+
+# 公式
+import datetime
+import pathlib
+import struct
+
+# MOV / MP4 のタイムスタンプの基準
+MOV_EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+
+# ファイル先頭に来るアトム (これ以外で始まるファイルは MOV / MP4 とみなさない)
+TOP_LEVEL_TYPES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot", b"uuid"}
+
+# hdlr のハンドラ種別 -> ffprobe の codec_type
+HANDLER_CODEC_TYPES = {
+    b"vide": "video",
+    b"soun": "audio",
+    b"text": "subtitle",
+    b"sbtl": "subtitle",
+    b"tmcd": "data",
+    b"meta": "data",
+}
+
+def iter_atoms(f, start, end):
+    """
+    [start, end) の範囲にあるアトムを (種別, 中身の開始位置, 終了位置) で順に返す
+    中身は読まずにシークで飛ばす
+    """
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        size, atom_type = struct.unpack(">I4s", header)
+        body = pos + 8
+        if size == 1:
+            # 64bit サイズ
+            size, = struct.unpack(">Q", f.read(8))
+            body += 8
+        elif size == 0:
+            # ファイルの最後まで
+            size = end - pos
+        if size < body - pos:
+            raise ValueError("broken atom: %r at %d" % (atom_type, pos))
+        yield atom_type, body, min(pos + size, end)
+        pos += size
+
+def to_datetime(seconds) -> datetime.datetime:
+    return MOV_EPOCH + datetime.timedelta(seconds=seconds)
+
+def format_time(dt: datetime.datetime) -> str:
+    """
+    ffprobe と同じ形式 (2023-08-13T01:38:43.000000Z) にする
+    """
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def decode_language(code) -> str:
+    """
+    mdhd の言語コード (ISO 639-2/T を 5bit x 3 に詰めたもの)
+    """
+    if code == 0 or code == 0x7fff:
+        return "und"
+    return "".join(chr(((code >> shift) & 0x1f) + 0x60) for shift in (10, 5, 0))
+
+def read_full_atom(f, body, end, formats):
+    """
+    バージョン付きのアトム (mvhd, tkhd, mdhd) を読み、version に応じた形式で unpack する
+    formats: (version 0 の形式, version 1 の形式)
+    """
+    f.seek(body)
+    version = f.read(4)[0]
+    fmt = formats[1] if version == 1 else formats[0]
+    size = struct.calcsize(fmt)
+    if body + 4 + size > end:
+        raise ValueError("atom too short")
+    return struct.unpack(fmt, f.read(size))
+
+def read_mvhd(f, body, end):
+    creation, modification, timescale, duration = read_full_atom(f, body, end, (">IIII", ">QQIQ"))
+    return {"creation_time": creation, "timescale": timescale, "duration": duration}
+
+def read_tkhd(f, body, end):
+    creation, modification, track_id = read_full_atom(f, body, end, (">III", ">QQI"))
+    return {"id": track_id}
+
+def read_mdhd(f, body, end):
+    creation, modification, timescale, duration, language = read_full_atom(f, body, end, (">IIIIH", ">QQIQH"))
+    return {"creation_time": creation, "timescale": timescale, "duration": duration, "language": language}
+
+def read_hdlr(f, body, end):
+    # version/flags(4) + pre_defined(4) + handler_type(4)
+    f.seek(body + 8)
+    return {"handler": f.read(4)}
+
+def read_trak(f, body, end):
+    track = dict()
+    for atom_type, child_body, child_end in iter_atoms(f, body, end):
+        if atom_type == b"tkhd":
+            track.update(read_tkhd(f, child_body, child_end))
+        elif atom_type == b"mdia":
+            for mdia_type, mdia_body, mdia_end in iter_atoms(f, child_body, child_end):
+                if mdia_type == b"mdhd":
+                    track.update(read_mdhd(f, mdia_body, mdia_end))
+                elif mdia_type == b"hdlr":
+                    track.update(read_hdlr(f, mdia_body, mdia_end))
+    return track
+
+def track_to_stream(index, track) -> dict:
+    """
+    トラックの情報を ffprobe の streams の要素と同じ形にする
+    """
+    stream = {
+        "index": index,
+        "codec_type": HANDLER_CODEC_TYPES.get(track.get("handler"), "unknown"),
+        "tags": {},
+    }
+    if "id" in track:
+        stream["id"] = "0x%x" % track["id"]
+
+    timescale = track.get("timescale", 0)
+    if timescale > 0:
+        stream["time_base"] = "1/%d" % timescale
+        stream["duration_ts"] = track["duration"]
+        stream["duration"] = "%.6f" % (track["duration"] / timescale)
+
+    if track.get("creation_time"):
+        stream["tags"]["creation_time"] = format_time(to_datetime(track["creation_time"]))
+    if "language" in track:
+        stream["tags"]["language"] = decode_language(track["language"])
+    return stream
+
+def read_movie_atoms(movie_path: pathlib.Path) -> dict:
+    """
+    MOV / MP4 のメタデータを ffprobe -show_streams -of json と同じ形で返す
+    MOV / MP4 でない、moov がないなどの場合は ValueError
+    """
+    with open(str(movie_path), "rb") as f:
+        f.seek(0, 2)
+        file_size = f.tell()
+
+        movie = None
+        tracks = []
+        for index, (atom_type, body, end) in enumerate(iter_atoms(f, 0, file_size)):
+            if index == 0 and atom_type not in TOP_LEVEL_TYPES:
+                raise ValueError("not a mov/mp4 file: %s" % movie_path)
+            if atom_type != b"moov":
+                continue
+
+            for moov_type, moov_body, moov_end in iter_atoms(f, body, end):
+                if moov_type == b"mvhd":
+                    movie = read_mvhd(f, moov_body, moov_end)
+                elif moov_type == b"trak":
+                    tracks.append(read_trak(f, moov_body, moov_end))
+            break
+
+    if movie is None:
+        raise ValueError("moov/mvhd not found: %s" % movie_path)
+
+    json_data = {
+        "streams": [track_to_stream(index, track) for index, track in enumerate(tracks)],
+        "format": {"tags": {}},
+    }
+    if movie["timescale"] > 0:
+        json_data["format"]["duration"] = "%.6f" % (movie["duration"] / movie["timescale"])
+    if movie["creation_time"]:
+        json_data["format"]["tags"]["creation_time"] = format_time(to_datetime(movie["creation_time"]))
+    return json_data
@@ -3,30 +3,86 @@ https://note.nkmk.me/python-opencv-videocapture-file-camera/
 """
 
 # 公式
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import datetime
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
 import pathlib
+import queue
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
+import typing
 
 # サードパーティ
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 
+# 自作
+import analyze_metadata
+import avi_file
+import ffmpeg_capture
+import ser_file
+
 # 画像の表示
 def display_image(img):
     cv2.imshow("img", img)
     cv2.waitKey()
     cv2.destroyAllWindows()
 
-def preprocess(img):
+def binarize(img):
+    """
+    グレースケール化・2値化し、(しきい値, 2値画像) を返す
+    img はカラー (BGR) でもグレースケールでもよい
+    """
     # グレースケール化
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     # メディアンフィルタ
     # img = cv2.medianBlur(img, 5)
     # 2値化
     # ret, img = cv2.threshold(img, 10, 255, cv2.THRESH_BINARY)
     # ret, img = cv2.threshold(img, 0, 255, cv2.THRESH_OTSU)
     ret, img = cv2.threshold(img, 0, 255, cv2.THRESH_TRIANGLE)
+    return ret, img
+
+def luma_image(frame):
+    """
+    検出に使う画像を返す
+    輝度を直接持っているフレーム (I420Frame) なら輝度 (H, W) を変換なしで返し、
+    それ以外 (BGR, グレースケール) はそのまま返す (BGR は binarize などでグレースケール化する)
+    """
+    if isinstance(frame, ffmpeg_capture.I420Frame):
+        return frame.y
+    return frame
+
+def crop_frame(frame, crop_range, gray=False):
+    """
+    フレームを crop_range = (x1, x2, y1, y2) で切り抜く
+    I420Frame は、gray なら輝度を、そうでなければ切り抜く範囲だけ BGR に変換して返す
+    """
+    x1, x2, y1, y2 = crop_range
+    if isinstance(frame, ffmpeg_capture.I420Frame):
+        if gray:
+            return frame.y[y1 : y2, x1 : x2]
+        return frame.to_bgr(x1, x2, y1, y2)
+    return frame[y1 : y2, x1 : x2]
+
+def preprocess(img):
+    ret, img = binarize(img)
     return img
 
 # 白割合を計算
@@ -35,16 +91,22 @@ def calc_white_rate(grey_img):
     white_area = cv2.countNonZero(grey_img)
     return white_area / grey_img.size
 
-# 白割合をもとに惑星が存在するか調べる
-def exists_planets(grey_img):
-    rate = calc_white_rate(grey_img)
-    
-    # しきい値は経験則的
-    if rate >= 0.00005 and rate < 0.1:
+# 惑星とみなす白割合の範囲 (しきい値は経験則的)
+PLANET_RATE_MIN = 0.00005
+PLANET_RATE_MAX = 0.1
+
+# 白割合が惑星の範囲か調べる
+def is_planet_rate(rate):
+    if rate >= PLANET_RATE_MIN and rate < PLANET_RATE_MAX:
         return True
     else:
         return False
 
+# 白割合をもとに惑星が存在するか調べる
+def exists_planets(grey_img):
+    rate = calc_white_rate(grey_img)
+    return is_planet_rate(rate)
+
 def calc_crop_range(width, height, center_x, center_y, crop_size):
     """
     「元画像のサイズ、切り抜きたい中心座標、切り抜きたいサイズ」を基に
@@ -90,101 +152,2199 @@ def calc_moment(grey_img):
     x, y = int(M["m10"]/M["m00"]) , int(M["m01"]/M["m00"])
     return x, y
 
-def main_cropping(infile_path: pathlib.Path, crop_size):
-    outfile_path = infile_path.parent / (infile_path.stem + "_crop.avi")
+def calc_projection_moment(binary_img):
+    """
+    2値画像の重心を、列・行ごとの白画素数 (射影) から計算する
+    calc_moment と同じく白画素の座標の平均 (同じ値) になるが、2次元の積和を取らないので軽い
+    """
+    cols = cv2.reduce(binary_img, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel().astype(np.int64)
+    rows = cv2.reduce(binary_img, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel().astype(np.int64)
+    total = cols.sum()
+    x = int(np.dot(cols, np.arange(len(cols))) / total)
+    y = int(np.dot(rows, np.arange(len(rows))) / total)
+    return x, y
+
+class CropStats:
+    """
+    main_cropping の処理ごとの時間とフレーム数
+
+    各処理の前後で perf_counter の差を足すだけなので、計測の負荷はほとんどない
+    スレッドのステージごとに別々の項目を書き換えるので、ロックは使わない
+    スレッドで並行に処理した場合、処理ごとの時間の合計は経過時間より長くなる
+    """
+    # 処理の種類 (デコード, 2値化, 重心計算, 切り抜き・選別, 書き出し)
+    STAGES = ("decode", "preprocess", "moments", "crop", "write")
+
+    def __init__(self, frames_all=0) -> None:
+        self.frames_all = frames_all
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        # デコードしたフレーム数
+        self.frames_read = 0
+        # 書き出し済みのフレームの次の番号 (進捗)
+        self.frames_done = 0
+        # 書き出したフレーム数
+        self.frames_written = 0
+        # 惑星が写っていないため書き出さなかったフレーム数
+        self.frames_no_planet = 0
+        # 鮮鋭度で選別して捨てたフレーム数
+        self.frames_dropped = 0
+        # 検出した回数と、そのうち惑星が写っていなかった回数
+        self.detections = 0
+        self.detections_no_planet = 0
+        self.start_time = time.perf_counter()
+
+    def add(self, stage, seconds, count=1):
+        self.seconds[stage] += seconds
+        self.counts[stage] += count
+
+    def add_detection(self, detection):
+        self.detections += 1
+        if not detection.present:
+            self.detections_no_planet += 1
+
+    def add_summary(self, summary: dict):
+        """
+        別のプロセスで処理した分の集計 (summary() の結果) を足す
+        """
+        self.frames_read += summary["frames_read"]
+        self.frames_done += summary["frames_done"]
+        self.frames_written += summary["frames_written"]
+        self.frames_no_planet += summary["frames_no_planet"]
+        self.frames_dropped += summary["frames_dropped"]
+        self.detections += summary["detections"]
+        self.detections_no_planet += summary["detections_no_planet"]
+        for stage, item in summary["stages"].items():
+            self.add(stage, item["seconds"], item["count"])
+
+    def summary(self) -> dict:
+        """
+        集計結果を dict で返す (プロセス間で受け渡しできるよう、基本的な型だけを使う)
+        """
+        return {
+            "frames_all": self.frames_all,
+            "frames_read": self.frames_read,
+            "frames_done": self.frames_done,
+            "frames_written": self.frames_written,
+            "frames_no_planet": self.frames_no_planet,
+            "frames_dropped": self.frames_dropped,
+            "detections": self.detections,
+            "detections_no_planet": self.detections_no_planet,
+            "elapsed": time.perf_counter() - self.start_time,
+            "stages": {stage: {"seconds": self.seconds[stage], "count": self.counts[stage]} for stage in self.STAGES},
+        }
+
+def format_crop_summary(summary: dict) -> str:
+    """
+    CropStats.summary() の結果を表示用の文字列にする
+    """
+    elapsed = summary["elapsed"]
+    lines = [
+        "frames: read %d / %d, written %d, no planet %d, dropped %d" % (
+            summary["frames_read"], summary["frames_all"], summary["frames_written"],
+            summary["frames_no_planet"], summary["frames_dropped"]),
+        "detections: %d (no planet %d)" % (summary["detections"], summary["detections_no_planet"]),
+        "elapsed: %.3f s (%.1f fps)" % (elapsed, summary["frames_read"] / elapsed if elapsed > 0 else 0),
+    ]
+    for stage, item in summary["stages"].items():
+        seconds, count = item["seconds"], item["count"]
+        lines.append("  %-10s %8.3f s  %7d calls  %8.3f ms/call" % (
+            stage, seconds, count, seconds / count * 1000 if count > 0 else 0))
+    return "\n".join(lines)
+
+def read_frames(inmovie, stats: CropStats = None):
+    """
+    動画を先頭から順に1回ずつデコードし、フレームを返すジェネレータ
+    シークは行わない
+    stats を指定するとデコード時間を記録する
+    """
+    while True:
+        t0 = time.perf_counter()
+        ret, frame = inmovie.read()
+        if not ret:
+            # 再生終了
+            break
+        if stats is not None:
+            stats.add("decode", time.perf_counter() - t0)
+            stats.frames_read += 1
+        yield frame
+
+def iter_frame_windows(frames, count, start=0):
+    """
+    フレームを count 枚ずつのウィンドウにまとめて返すジェネレータ
+    リングバッファで保持するのは現在のウィンドウ count 枚分のみ
+    start は最初のフレームの番号で、ウィンドウの境界は常に count の倍数のフレームにそろえる
+    (途中から処理する場合、最初のウィンドウは次の倍数までの端数になる)
+    """
+    window = collections.deque(maxlen=count)
+    size = count - start % count
+    for frame in frames:
+        window.append(frame)
+        if len(window) == size:
+            yield list(window)
+            window.clear()
+            size = count
+
+    # 端数のウィンドウ
+    if len(window) != 0:
+        yield list(window)
+
+class Detection(typing.NamedTuple):
+    """
+    1フレームの検出結果
+    """
+    # 惑星が写っているか
+    present: bool
+    # 重心座標
+    x: int = 0
+    y: int = 0
+    # 白割合 (フレーム全体に対する割合)
+    white_rate: float = 0.0
+    # 2値化のしきい値
+    threshold: float = 0.0
+
+    @property
+    def pos(self):
+        return (self.x, self.y) if self.present else None
+
+def detect_planet(frame, stats: CropStats = None):
+    """
+    1フレームから惑星を検出して Detection を返す
+    stats を指定すると2値化・重心計算の時間を記録する
+    """
+    # 前処理
+    t0 = time.perf_counter()
+    thresh, img = binarize(frame)
+    rate = calc_white_rate(img)
+    t1 = time.perf_counter()
+    if stats is not None:
+        stats.add("preprocess", t1 - t0)
+
+    # 惑星写ってなかったら present が False
+    if not is_planet_rate(rate):
+        return Detection(False, white_rate=rate, threshold=thresh)
+
+    # 重心計算 (2値画像なので、行・列の射影から求めても calc_moment と同じ値になる)
+    x, y = calc_projection_moment(img)
+    if stats is not None:
+        stats.add("moments", time.perf_counter() - t1)
+    return Detection(True, x, y, rate, thresh)
+
+# cv2.calcHist (float32) で画素数を正確に数えられる1フレームの最大画素数 (超えるフレームは np.bincount で数える)
+CALCHIST_MAX_PIXELS = 1 << 24
+
+def to_luma_block(frames, out=None):
+    """
+    フレームのリストを (N, H, W) のグレースケール画像のブロックにする
+    out を指定するとそこに書き込む (大きさが合わなければ作り直す)
+    """
+    height, width = frames[0].shape[:2]
+    shape = (len(frames), height, width)
+    if out is None or out.shape != shape:
+        out = np.empty(shape, np.uint8)
+    for i, frame in enumerate(frames):
+        frame = luma_image(frame)
+        if frame.ndim == 3:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=out[i])
+        else:
+            out[i] = frame
+    return out
+
+def calc_histograms(block):
+    """
+    (N, H, W) のブロックの、フレームごとの輝度ヒストグラム (N, 256) を返す
+    """
+    count, height, width = block.shape
+    hists = np.empty((count, 256), np.int64)
+    for i in range(count):
+        if height * width <= CALCHIST_MAX_PIXELS:
+            hists[i] = cv2.calcHist([block[i]], [0], None, [256], [0, 256]).ravel()
+        else:
+            hists[i] = np.bincount(block[i].ravel(), minlength=256)
+    return hists
+
+def triangle_thresholds(hists):
+    """
+    ヒストグラム (N, 256) から、フレームごとの三角法のしきい値 (N,) をまとめて求める
+    OpenCV の THRESH_TRIANGLE (getThreshVal_Triangle_8u) と同じ値になるように、同じ手順をベクトル化している
+    """
+    n = hists.shape[1]
+    rows = np.arange(len(hists))
+    bins = np.arange(n)
+    nonzero = hists > 0
+
+    # 値のある範囲の左端・右端 (1つ外側)
+    left = np.argmax(nonzero, axis=1)
+    left = np.where(left > 0, left - 1, left)
+    # 右端は 1 以上の範囲で探す (0 にしか値がなければ 0)
+    right = np.where(nonzero[:, 1:].any(axis=1), n - 1 - np.argmax(nonzero[:, :0:-1], axis=1), 0)
+    right = np.where(right < n - 1, right + 1, right)
+
+    # ピーク (最初の最大値)
+    max_ind = np.argmax(hists, axis=1)
+    max_value = hists[rows, max_ind]
+
+    # ピークの右側の方が広ければ、ヒストグラムを反転して左側で探す
+    flipped = (max_ind - left) < (right - max_ind)
+    hists = np.where(flipped[:, None], hists[:, ::-1], hists)
+    left = np.where(flipped, n - 1 - right, left)
+    max_ind = np.where(flipped, n - 1 - max_ind, max_ind)
+
+    # (left, 0) と (ピーク, 最大値) を結ぶ直線から最も離れた位置 (定数倍は省略した距離)
+    a = max_value.astype(np.float64)
+    b = (left - max_ind).astype(np.float64)
+    dist = a[:, None] * bins + b[:, None] * hists
+    in_range = (bins > left[:, None]) & (bins <= max_ind[:, None])
+    dist = np.where(in_range, dist, -np.inf)
+    best = np.argmax(dist, axis=1)
+    thresh = np.where(dist[rows, best] > 0, best, left) - 1
+
+    return np.where(flipped, n - 1 - thresh, thresh).astype(np.float64)
+
+def detect_batch(block, stats: CropStats = None) -> list:
+    """
+    (N, H, W) のグレースケール画像のブロックから、フレームごとに惑星を検出して Detection のリストを返す
+
+    しきい値はヒストグラムから三角法で、白割合はヒストグラムの累積和から求め、
+    重心は惑星が写っているフレームだけ2値化して、行・列ごとの画素数 (calc_projection_moment) から求める
+    結果は1フレームずつ detect_planet で求めたものと一致する
+    stats を指定すると2値化・重心計算の時間を記録する
+    """
+    count, height, width = block.shape
+    size = height * width
+
+    # しきい値と白割合 (しきい値より大きい画素の数)
+    t0 = time.perf_counter()
+    hists = calc_histograms(block)
+    thresholds = triangle_thresholds(hists)
+    cumsum = np.concatenate([np.zeros((count, 1), np.int64), np.cumsum(hists, axis=1)], axis=1)
+    first_white = np.clip(thresholds.astype(np.int64) + 1, 0, 256)
+    white_areas = size - cumsum[np.arange(count), first_white]
+    rates = white_areas / size
+    t1 = time.perf_counter()
+    if stats is not None:
+        stats.add("preprocess", t1 - t0, count)
+
+    # 惑星が写っているフレームだけ2値化して重心を求める
+    detections = [Detection(False, white_rate=rate, threshold=thresh) for rate, thresh in zip(rates.tolist(), thresholds.tolist())]
+    present = [i for i, rate in enumerate(rates.tolist()) if is_planet_rate(rate)]
+    binary = np.empty((height, width), np.uint8)
+    for i in present:
+        cv2.threshold(block[i], thresholds[i], 255, cv2.THRESH_BINARY, dst=binary)
+        x, y = calc_projection_moment(binary)
+        detections[i] = Detection(True, x, y, detections[i].white_rate, detections[i].threshold)
+    if stats is not None:
+        stats.add("moments", time.perf_counter() - t1, len(present))
+
+    return detections
+
+# 鮮鋭度の計算
+def calc_sharpness(img):
+    """
+    ラプラシアンの分散を鮮鋭度として返す (大きいほどシャープ)
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    lap = cv2.Laplacian(img, cv2.CV_32F)
+    mean, stddev = cv2.meanStdDev(lap)
+    return float(stddev[0, 0]) ** 2
+
+def check_keep_options(keep_count=None, keep_percent=None):
+    """
+    フレーム選別の指定 (keep_count は 1 以上、keep_percent は 0 より大きく 100 以下) を確かめる (不正なら ValueError)
+    """
+    if keep_count is not None and keep_count < 1:
+        raise ValueError("keep_count must be at least 1: %s" % keep_count)
+    if keep_percent is not None and not (0 < keep_percent <= 100):
+        raise ValueError("keep_percent must be in (0, 100]: %s" % keep_percent)
+
+def resolve_keep_count(keep_count, keep_percent, frames_all):
+    """
+    残すフレーム数 (選別しなければ None)
+    keep_percent を指定した場合は全フレーム数から求める (フレーム数が分からなくても 1 枚は残す)
+    """
+    check_keep_options(keep_count, keep_percent)
+    if keep_percent is not None:
+        return max(1, math.ceil(frames_all * keep_percent / 100))
+    return keep_count
+
+class FrameSelector:
+    """
+    切り抜いたフレームを順に鮮鋭度でスコア付けし、上位 keep_count 枚だけを残す (ラッキーイメージング)
+    メモリに保持するのは上位 keep_count 枚の (スコア, フレーム番号) と、全フレームのスコアのみ
+    切り抜き画像は上位に入ったときに spill_dir の一時ファイル (SER) に書き出し、selected() で読み出す
+    (一時ファイルには後で上位から外れた画像も残るので、大きさは上位に入った回数分になる)
+    """
+    def __init__(self, keep_count, spill_dir: pathlib.Path = None) -> None:
+        if keep_count < 1:
+            raise ValueError("keep_count must be at least 1: %s" % keep_count)
+        self.keep_count = keep_count
+        # (スコア, フレーム番号, 一時ファイル内の位置) の最小ヒープ
+        self.heap = []
+        # (フレーム番号, スコア) の全履歴
+        self.scores = []
+        # 画像の一時ファイル (None なら標準の一時ディレクトリ)
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self.spill = None
+
+    def add(self, index, img):
+        score = calc_sharpness(img)
+        self.scores.append((index, score))
+
+        if len(self.heap) < self.keep_count:
+            heapq.heappush(self.heap, (score, index, self.spill_image(img)))
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (score, index, self.spill_image(img)))
+
+    def spill_image(self, img):
+        """
+        画像を一時ファイルに追記し、その位置を返す
+        """
+        if self.spill is None:
+            fd, path = tempfile.mkstemp(prefix="selected_", suffix=".ser",
+                                        dir=str(self.spill_dir) if self.spill_dir is not None else None)
+            os.close(fd)
+            self.spill_path = pathlib.Path(path)
+            height, width = img.shape[:2]
+            self.spill = ser_file.SerWriter(self.spill_path, width, height, "mono8" if img.ndim == 2 else "rgb8")
+        self.spill.write(img)
+        return self.spill.frame_count - 1
+
+    def selected(self):
+        """
+        残したフレームを (フレーム番号, 画像) で、フレーム番号順に返すジェネレータ
+        画像のバッファは使い回すので、次のフレームを取り出す前に書き出すこと
+        """
+        if self.spill is None:
+            return
+        self.spill.release()
+        # メモリマップだと読んだ分だけ常駐メモリが増えるので、1フレーム分のバッファに読み込む
+        buffer = np.empty_like(self.spill.buffer8)
+        with open(str(self.spill_path), "rb") as f:
+            for score, index, position in sorted(self.heap, key=lambda e: e[1]):
+                f.seek(ser_file.SER_HEADER_SIZE + position * buffer.nbytes)
+                f.readinto(memoryview(buffer).cast("B"))
+                yield index, buffer
+
+    def close(self):
+        """
+        一時ファイルを削除する
+        """
+        if self.spill is None:
+            return
+        self.spill.release()
+        self.spill = None
+        self.spill_path.unlink(missing_ok=True)
+
+    def save_scores(self, save_path: pathlib.Path):
+        """
+        全フレームのスコアと採否を CSV に保存する
+        """
+        selected_indices = set(index for score, index, img in self.heap)
+        with open(str(save_path), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "score", "selected"])
+            for index, score in self.scores:
+                writer.writerow([index, score, int(index in selected_indices)])
+
+class FullFrameDetector:
+    """
+    毎回フレーム全体で惑星を検出する
+    """
+    # 処理時間の記録先 (CropStats)
+    stats = None
+
+    def detect(self, frame, index=None):
+        return detect_planet(luma_image(frame), self.stats)
+
+class RoiTrackingDetector:
+    """
+    最初だけフレーム全体を探索して惑星を捕捉し、
+    以降は前回の重心を中心とした探索窓の中だけで2値化・重心計算を行う
+    探索窓で見失ったらフレーム全体の探索に戻る
+    """
+    # 処理時間の記録先 (CropStats)
+    stats = None
+
+    def __init__(self, search_size) -> None:
+        # 探索窓のサイズ (偶数)
+        self.search_size = search_size
+        # 前回の重心座標
+        self.last_pos = None
+
+    def detect(self, frame, index=None):
+        frame = luma_image(frame)
+        if self.last_pos is not None:
+            detection = self.detect_in_window(frame)
+            if detection is not None:
+                self.last_pos = detection.pos
+                return detection
+
+        # 捕捉・再捕捉はフレーム全体で
+        detection = detect_planet(frame, self.stats)
+        self.last_pos = detection.pos
+        return detection
+
+    def detect_in_window(self, frame):
+        """
+        探索窓の中で惑星を検出し、フレーム全体での座標の Detection を返す
+        見失ったら None を返す
+        """
+        height, width = frame.shape[:2]
+        search_size = min(self.search_size, width, height) // 2 * 2
+        x, y = self.last_pos
+        x1, x2, y1, y2 = calc_crop_range(width, height, x, y, search_size)
+
+        t0 = time.perf_counter()
+        thresh, img = binarize(frame[y1 : y2, x1 : x2])
+
+        # 白割合はフレーム全体に対する割合で exists_planets と同じ基準で判定する
+        white_area = cv2.countNonZero(img)
+        rate = white_area / (width * height)
+        t1 = time.perf_counter()
+        if self.stats is not None:
+            self.stats.add("preprocess", t1 - t0)
+        if not is_planet_rate(rate):
+            return None
+
+        # 探索窓の半分以上が白なら、2値化が背景を拾っている
+        if white_area * 2 > img.size:
+            return None
+
+        # 重心計算
+        wx, wy = calc_projection_moment(img)
+
+        # 惑星 (重心を含む連結成分、重心が黒なら最大の連結成分) が窓の縁 (フレームの端を除く) にかかっていたら、
+        # 窓からはみ出している (縁にかかった孤立したノイズは無視する)
+        count, labels, components, centroids = cv2.connectedComponentsWithStats(img, connectivity=8)
+        label = labels[wy, wx]
+        if label == 0:
+            label = 1 + int(np.argmax(components[1:, cv2.CC_STAT_AREA]))
+        left, top, w, h = components[label, :4]
+        if (y1 > 0 and top == 0) or (y2 < height and top + h == img.shape[0]) \
+                or (x1 > 0 and left == 0) or (x2 < width and left + w == img.shape[1]):
+            return None
+        if self.stats is not None:
+            self.stats.add("moments", time.perf_counter() - t1)
+        return Detection(True, wx + x1, wy + y1, rate, thresh)
+
+class BatchDetector:
+    """
+    ウィンドウのフレームをまとめてグレースケールのブロックにし、全フレームを detect_batch で検出する
+    フレームごとに重心を求めるので、ウィンドウ内のフレームはそれぞれの位置で切り抜ける
+    """
+    # 処理時間の記録先 (CropStats)
+    stats = None
+
+    def __init__(self) -> None:
+        # ブロックのバッファ (ウィンドウごとに使い回す)
+        self.block = None
+
+    def detect(self, frame, index=None):
+        return self.detect_window([frame], index)[0]
+
+    def detect_window(self, frames, start=None):
+        """
+        ウィンドウの各フレームの Detection のリストを返す
+        """
+        t0 = time.perf_counter()
+        self.block = to_luma_block(frames, self.block)
+        if self.stats is not None:
+            self.stats.add("preprocess", time.perf_counter() - t0, 0)
+        return detect_batch(self.block, self.stats)
+
+class DetectionTrack:
+    """
+    フレームごとの検出結果 (トラック)
+
+    検出したフレームの番号・重心座標・白割合・しきい値・惑星の有無を保持し、
+    動画の横に "<stem>_track.npz" として保存する
+    切り抜きサイズを変えて切り抜き直すときや、プレビューの枠表示・ドリフトのグラフで再利用する
+    """
+    def __init__(self) -> None:
+        self.frames = []
+        self.detections = []
+
+    @staticmethod
+    def track_path(infile_path: pathlib.Path):
+        return infile_path.parent / (infile_path.stem + "_track.npz")
+
+    @staticmethod
+    def file_key(infile_path: pathlib.Path):
+        stat = infile_path.stat()
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def add(self, index, detection: Detection):
+        self.frames.append(index)
+        self.detections.append(detection)
+
+    def save(self, infile_path: pathlib.Path, detector, count, adaptive=False, decoder="opencv"):
+        """
+        動画の横に保存する (動画のサイズ・更新日時と、検出方式・チェック間隔・adaptive・デコーダも保存する)
+        """
+        # フレーム番号順に並べる
+        order = sorted(range(len(self.frames)), key=lambda i: self.frames[i])
+        detections = [self.detections[i] for i in order]
+        np.savez_compressed(
+            str(self.track_path(infile_path)),
+            frame=np.array([self.frames[i] for i in order], dtype=np.int32),
+            x=np.array([d.x for d in detections], dtype=np.int32),
+            y=np.array([d.y for d in detections], dtype=np.int32),
+            white_rate=np.array([d.white_rate for d in detections], dtype=np.float32),
+            threshold=np.array([d.threshold for d in detections], dtype=np.float32),
+            present=np.array([d.present for d in detections], dtype=bool),
+            key=self.file_key(infile_path),
+            detector=np.array(detector),
+            count=np.array(count),
+            adaptive=np.array(adaptive),
+            decoder=np.array(decoder),
+        )
+
+    @classmethod
+    def load(cls, infile_path: pathlib.Path, detector=None, count=None, adaptive=False, decoder="opencv"):
+        """
+        保存済みのトラックを読み込む
+        動画が変わっている場合は None を返す
+        detector を指定した場合 (切り抜きに使う場合)、検出方式・チェック間隔 (count)・adaptive・デコーダの
+        どれかが違うトラックも None を返す (チェックするフレームや検出結果が違うため)
+        """
+        track_path = cls.track_path(infile_path)
+        if not track_path.exists():
+            return None
+
+        with np.load(str(track_path)) as data:
+            if not np.array_equal(data["key"], cls.file_key(infile_path)):
+                return None
+            if detector is not None:
+                if not all(name in data.files for name in ("count", "adaptive", "decoder")):
+                    return None
+                if (str(data["detector"]) != detector or int(data["count"]) != count
+                        or bool(data["adaptive"]) != adaptive or str(data["decoder"]) != decoder):
+                    return None
+
+            track = cls()
+            track.frames = data["frame"].tolist()
+            track.detections = [
+                Detection(bool(present), int(x), int(y), float(white_rate), float(threshold))
+                for present, x, y, white_rate, threshold
+                in zip(data["present"], data["x"], data["y"], data["white_rate"], data["threshold"])
+            ]
+        return track
+
+    def lookup(self, index):
+        """
+        index 番目のフレームの検出結果を返す
+        検出していないフレームは、前後の検出結果から重心座標を線形補間する
+        """
+        i = bisect.bisect_right(self.frames, index) - 1
+        if i < 0:
+            return Detection(False)
+
+        prev = self.detections[i]
+        if self.frames[i] == index or not prev.present or i + 1 >= len(self.frames):
+            return prev
+
+        following = self.detections[i + 1]
+        if not following.present:
+            return prev
+
+        # 前後の検出結果から補間
+        t = (index - self.frames[i]) / (self.frames[i + 1] - self.frames[i])
+        x = round(prev.x + (following.x - prev.x) * t)
+        y = round(prev.y + (following.y - prev.y) * t)
+        return prev._replace(x=x, y=y)
+
+def plot_track(track: DetectionTrack, save_path: pathlib.Path):
+    """
+    トラックの重心座標の推移 (ドリフト) をグラフにして保存する
+    """
+    frames = np.array([index for index, d in zip(track.frames, track.detections) if d.present])
+    pos = np.array([[d.x, d.y] for d in track.detections if d.present]).reshape(-1, 2)
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
+    ax1.scatter(pos[:, 0], pos[:, 1], color='red', s=2.0, label='moment')
+    ax1.invert_yaxis()
+    ax1.set_xlabel('x', color='black', fontsize=14)
+    ax1.set_ylabel('y', color='black', fontsize=14)
+    ax2.plot(frames, pos[:, 0] - pos[0, 0] if len(pos) else [], label='x')
+    ax2.plot(frames, pos[:, 1] - pos[0, 1] if len(pos) else [], label='y')
+    ax2.set_xlabel('frame', color='black', fontsize=14)
+    ax2.set_ylabel('drift [px]', color='black', fontsize=14)
+    ax2.legend()
+    fig.savefig(str(save_path), dpi=150)
+    plt.close(fig)
+
+class TrackDetector:
+    """
+    保存済みのトラックから検出結果を返す (画像処理は行わない)
+    """
+    # 処理時間の記録先 (CropStats, 画像処理を行わないので使わない)
+    stats = None
+
+    def __init__(self, track: DetectionTrack) -> None:
+        self.track = track
+
+    def detect(self, frame, index=None):
+        return self.track.lookup(index)
+
+    def detect_window(self, frames, start=None):
+        return [self.track.lookup(start + i) for i in range(len(frames))]
+
+class SeededDetector:
+    """
+    区間の先頭フレーム (index) では、別のプロセスで検出済みの結果 (detection) を1回だけ返し、
+    それ以外は detector で検出する
+    区間の先頭がウィンドウの途中にある場合に、ウィンドウ先頭での検出結果を引き継ぐために使う
+    """
+    def __init__(self, detector, index, detection) -> None:
+        self.detector = detector
+        self.index = index
+        self.detection = detection
+
+    @property
+    def stats(self):
+        return self.detector.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.detector.stats = stats
+
+    def detect(self, frame, index=None):
+        if index == self.index and self.detection is not None:
+            detection, self.detection = self.detection, None
+            return detection
+        return self.detector.detect(frame, index)
+
+    def detect_window(self, frames, start=None):
+        return self.detector.detect_window(frames, start)
+
+# 検出方式ごとの、座標をチェックするフレーム間隔の既定値
+DETECTOR_INTERVALS = {
+    "full": 10,
+    "roi": 1,
+    "batch": 10,
+}
+
+def create_detector(detector, crop_size):
+    """
+    検出方式の名前から検出器を作る
+    """
+    if detector == "full":
+        return FullFrameDetector()
+    elif detector == "roi":
+        return RoiTrackingDetector(crop_size)
+    elif detector == "batch":
+        return BatchDetector()
+    else:
+        raise ValueError("unknown detector: %s" % detector)
+
+class CropChunk(typing.NamedTuple):
+    """
+    検出ステージから書き出しステージへ渡す、連続したフレームのまとまり
+    """
+    # 先頭フレームの番号
+    start: int
+    # フレームのリスト
+    frames: list
+    # 検出した重心座標 (惑星が写っていなければ None)
+    pos: typing.Optional[tuple]
+    # フレームごとの切り抜き範囲 (書き出さないフレームは None)
+    ranges: list
+
+def plan_crop_windows(windows, detector, width, height, crop_size, track: DetectionTrack = None, stats: CropStats = None,
+                      start=0):
+    """
+    ウィンドウごとに先頭フレームで惑星を検出し、CropChunk を返すジェネレータ
+    ウィンドウ内のフレームはすべて同じ範囲で切り抜く
+    惑星が写っていないウィンドウは書き出さない
+    track を指定すると検出結果を記録する
+    stats を指定すると検出回数を記録する
+    start は最初のフレームの番号
+    """
+    for window in windows:
+        detection = detector.detect(window[0], start)
+        if track is not None:
+            track.add(start, detection)
+        if stats is not None:
+            stats.add_detection(detection)
+
+        if not detection.present:
+            crop_range = None
+        else:
+            # 切り出しサイズ決定
+            crop_range = calc_crop_range(width, height, detection.x, detection.y, crop_size)
+
+        yield CropChunk(start, window, detection.pos, [crop_range] * len(window))
+        start += len(window)
+
+def plan_batch_crops(windows, detector, width, height, crop_size, track: DetectionTrack = None, stats: CropStats = None,
+                     start=0):
+    """
+    ウィンドウの全フレームをまとめて検出し (detector.detect_window)、CropChunk を返すジェネレータ
+    各フレームをそれぞれの重心で切り抜き、惑星が写っていないフレームは書き出さない
+    track を指定すると検出結果を記録する
+    stats を指定すると検出回数を記録する
+    start は最初のフレームの番号
+    """
+    for window in windows:
+        detections = detector.detect_window(window, start)
+
+        ranges = []
+        pos = None
+        for i, detection in enumerate(detections):
+            if track is not None:
+                track.add(start + i, detection)
+            if stats is not None:
+                stats.add_detection(detection)
+
+            if not detection.present:
+                ranges.append(None)
+            else:
+                ranges.append(calc_crop_range(width, height, detection.x, detection.y, crop_size))
+                if pos is None:
+                    pos = detection.pos
+
+        yield CropChunk(start, window, pos, ranges)
+        start += len(window)
+
+# 複数対象の検出で、対象とみなす白領域の最小画素数 (これより小さいものはノイズとみなす)
+MIN_TARGET_AREA = 4
+# 対象とみなす白領域の、最も大きい白領域に対する最小の画素数の割合 (これより小さいものはノイズとみなす)
+MIN_TARGET_AREA_RATIO = 0.005
+# 新しい対象として捕捉するまでに、続けて写っている必要があるチェックの回数
+TARGET_CONFIRM_CHECKS = 3
+
+def detect_targets(frame, min_area=MIN_TARGET_AREA, stats: CropStats = None, min_area_ratio=MIN_TARGET_AREA_RATIO):
+    """
+    1フレームから白領域をラベリングし、(x, y, 画素数) のリストを画素数の大きい順に返す
+    画素数が min_area 未満、または最も大きい白領域の min_area_ratio 倍未満の白領域は除く
+    フレーム全体の白割合が惑星の範囲でなければ空のリストを返す
+    座標は calc_moment と同じく重心を切り捨てたもの
+    """
+    t0 = time.perf_counter()
+    thresh, img = binarize(luma_image(frame))
+    rate = calc_white_rate(img)
+    t1 = time.perf_counter()
+    if stats is not None:
+        stats.add("preprocess", t1 - t0)
+    if not is_planet_rate(rate):
+        return []
+
+    n, labels, components, centroids = cv2.connectedComponentsWithStats(img)
+    areas = components[1:, cv2.CC_STAT_AREA]
+    if len(areas) != 0:
+        min_area = max(min_area, int(areas.max()) * min_area_ratio)
+    targets = []
+    for label in range(1, n):
+        area = int(components[label, cv2.CC_STAT_AREA])
+        if area >= min_area:
+            targets.append((int(centroids[label, 0]), int(centroids[label, 1]), area))
+    targets.sort(key=lambda target: -target[2])
+    if stats is not None:
+        stats.add("moments", time.perf_counter() - t1)
+    return targets
+
+class TargetTracker:
+    """
+    複数の対象 (惑星と衛星など) をフレーム間で追跡する
+
+    対象の番号は、捕捉したときの大きさの順 (0 が最も大きい)
+    各対象は前回の位置に最も近い白領域に対応づけ、前回の位置から max_distances[i] 以上離れたものは別の物体とみなす
+    見失った対象は最後の位置を覚えておき、近くに現れたら再び対応づける
+    どの対象にも対応づかなかった白領域は候補とし、confirm_checks 回のチェックで続けて近くに写ったら
+    空いている番号に大きい順に割り当てる (一度だけ写ったノイズで番号を埋めないため)
+    捕捉した対象の、それまでのチェックでの位置は update の後の backfill に入る (呼び出し側で遡って切り抜くため)
+    """
+    def __init__(self, max_distances, confirm_checks=TARGET_CONFIRM_CHECKS) -> None:
+        self.max_distances = list(max_distances)
+        self.confirm_checks = confirm_checks
+        # 対象ごとの最後の位置 (一度も捕捉していなければ None)
+        self.last_positions = [None] * len(self.max_distances)
+        # 捕捉前の候補の [位置, それまでのチェックでの位置のリスト (古い順)] のリスト
+        self.candidates = []
+        # 直前の update で捕捉した対象の番号と、それまでの confirm_checks - 1 回のチェックでの位置 (古い順)
+        self.backfill = dict()
+
+    def update(self, targets):
+        """
+        detect_targets の結果から、対象ごとの位置 (写っていなければ None) のリストを返す
+        """
+        unclaimed = list(targets)
+        positions = [None] * len(self.max_distances)
+        self.backfill = dict()
+
+        # 捕捉済みの対象を、最も近い白領域に対応づける
+        for i, last_pos in enumerate(self.last_positions):
+            if last_pos is None or len(unclaimed) == 0:
+                continue
+            distances = [math.hypot(x - last_pos[0], y - last_pos[1]) for x, y, area in unclaimed]
+            k = int(np.argmin(distances))
+            if distances[k] < self.max_distances[i]:
+                x, y, area = unclaimed.pop(k)
+                positions[i] = (x, y)
+
+        # 残った白領域を大きい順に候補に対応づけ、続けて写った位置を記録する (今回写らなかった候補は消す)
+        free = [i for i, last_pos in enumerate(self.last_positions) if last_pos is None]
+        candidates = []
+        if len(free) != 0:
+            max_distance = min(self.max_distances[i] for i in free)
+            previous = self.candidates
+            for x, y, area in unclaimed:
+                history = []
+                if len(previous) != 0:
+                    distances = [math.hypot(x - pos[0], y - pos[1]) for pos, seen in previous]
+                    k = int(np.argmin(distances))
+                    if distances[k] < max_distance:
+                        pos, seen = previous.pop(k)
+                        history = (seen + [pos])[-(self.confirm_checks - 1):] if self.confirm_checks > 1 else []
+                candidates.append([(x, y), history])
+
+        # 続けて写った候補を、空いている番号に大きい順に割り当てる
+        for candidate in list(candidates):
+            if len(free) == 0:
+                break
+            pos, history = candidate
+            if len(history) + 1 >= self.confirm_checks:
+                target = free.pop(0)
+                positions[target] = pos
+                self.backfill[target] = history
+                candidates.remove(candidate)
+        self.candidates = candidates
+
+        for i, pos in enumerate(positions):
+            if pos is not None:
+                self.last_positions[i] = pos
+        return positions
+
+class TargetChunk(typing.NamedTuple):
+    """
+    複数対象の検出ステージから書き出しステージへ渡す、連続したフレームのまとまり
+    """
+    # 先頭フレームの番号
+    start: int
+    # フレームのリスト
+    frames: list
+    # 対象ごとの重心座標 (写っていなければ None)
+    positions: list
+    # 対象ごとの、フレームごとの切り抜き範囲 (書き出さないフレームは None)
+    ranges: list
+
+def plan_target_crops(windows, tracker: TargetTracker, width, height, crop_sizes, min_area=MIN_TARGET_AREA,
+                      stats: CropStats = None):
+    """
+    ウィンドウごとに先頭フレームで複数の対象を検出・追跡し、TargetChunk を返すジェネレータ
+    対象ごとに、ウィンドウ内のフレームはすべて同じ範囲 (対象ごとの切り抜きサイズ) で切り抜く
+    対象は捕捉するまでに tracker.confirm_checks 回のチェックがかかるので、直前の confirm_checks - 1 ウィンドウを
+    手元に残しておき、捕捉したときに遡ってそれまでの位置で切り抜く
+    """
+    def crop_ranges(pos, crop_size, length):
+        if pos is None:
+            return [None] * length
+        return [calc_crop_range(width, height, pos[0], pos[1], crop_size)] * length
+
+    # 書き出しを待たせているチャンク (古い順)
+    delayed = collections.deque()
+    start = 0
+    for window in windows:
+        targets = detect_targets(window[0], min_area, stats)
+        positions = tracker.update(targets)
+        if stats is not None:
+            stats.add_detection(Detection(len(targets) != 0))
+
+        # 今回捕捉した対象を、待たせているチャンクでも切り抜く
+        for target, history in tracker.backfill.items():
+            n = min(len(delayed), len(history))
+            for chunk, pos in zip(list(delayed)[len(delayed) - n:], history[len(history) - n:]):
+                chunk.positions[target] = pos
+                chunk.ranges[target] = crop_ranges(pos, crop_sizes[target], len(chunk.frames))
+
+        ranges = [crop_ranges(pos, crop_size, len(window)) for pos, crop_size in zip(positions, crop_sizes)]
+        delayed.append(TargetChunk(start, window, positions, ranges))
+        start += len(window)
+        if len(delayed) >= tracker.confirm_checks:
+            yield delayed.popleft()
+
+    while delayed:
+        yield delayed.popleft()
+
+class AdaptiveInterval:
+    """
+    重心の移動速度から、次に座標をチェックするまでのフレーム間隔を決める
+    止まっているときは間隔を広げ、切り抜き枠の余裕 (margin) を使い切りそうなときは狭める
+    """
+    def __init__(self, crop_size, initial_interval=10, min_interval=1, max_interval=60, margin_ratio=0.1) -> None:
+        self.initial_interval = initial_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # チェック間に許容するずれ [px]
+        self.margin = crop_size * margin_ratio
+
+    def next_interval(self, speed):
+        """
+        speed: 重心の移動速度 [px/frame] (不明なら None)
+        """
+        if speed is None:
+            return self.initial_interval
+        if speed <= 0:
+            return self.max_interval
+
+        interval = int(self.margin / speed)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+def plan_adaptive_crops(windows, detector, width, height, crop_size, interval: AdaptiveInterval,
+                        track: DetectionTrack = None, stats: CropStats = None, start=0):
+    """
+    重心の移動速度に応じた間隔で惑星を検出し、CropChunk を返すジェネレータ
+    チェックとチェックの間のフレームは、前後の重心座標を線形補間した位置で切り抜く
+    見失ったときは、前回チェック以降のフレームを前回の位置のまま切り抜き、
+    以降のフレームは次に検出できるまで書き出さない
+    track を指定すると検出結果を記録する
+    stats を指定すると検出回数を記録する
+    start は最初のフレームの番号
+    """
+    # 前回チェックしたフレーム以降のフレーム (前回チェックしたフレームを含む)
+    pending = []
+    # 前回チェックしたフレームの番号・重心座標・速度
+    last_index = None
+    last_pos = None
+    last_velocity = None
+
+    def hold_pending():
+        # 前回の位置のまま切り抜く
+        crop_range = calc_crop_range(width, height, last_pos[0], last_pos[1], crop_size)
+        return CropChunk(last_index, pending, last_pos, [crop_range] * len(pending))
+
+    next_index = start
+    index = start
+    for window in windows:
+        for frame in window:
+            if index == next_index:
+                detection = detector.detect(frame, index)
+                if track is not None:
+                    track.add(index, detection)
+                if stats is not None:
+                    stats.add_detection(detection)
+                pos = detection.pos
+
+                if pos is None:
+                    # 見失った
+                    if last_pos is not None:
+                        yield hold_pending()
+                    yield CropChunk(index, [frame], None, [None])
+                    pending = []
+                    last_index = last_pos = last_velocity = None
+                    next_index = index + interval.min_interval
+
+                elif last_pos is None:
+                    # 捕捉
+                    pending = [frame]
+                    last_index, last_pos = index, pos
+                    next_index = index + interval.next_interval(None)
+
+                else:
+                    # 前回チェック以降のフレームを補間した位置で切り抜く
+                    span = index - last_index
+                    ranges = []
+                    for k in range(span):
+                        x = round(last_pos[0] + (pos[0] - last_pos[0]) * k / span)
+                        y = round(last_pos[1] + (pos[1] - last_pos[1]) * k / span)
+                        ranges.append(calc_crop_range(width, height, x, y, crop_size))
+                    yield CropChunk(last_index, pending, last_pos, ranges)
+
+                    # 速度と、等速で予測した位置からのずれ
+                    velocity = ((pos[0] - last_pos[0]) / span, (pos[1] - last_pos[1]) / span)
+                    speed = (velocity[0] ** 2 + velocity[1] ** 2) ** 0.5
+                    if last_velocity is not None:
+                        error_x = pos[0] - (last_pos[0] + last_velocity[0] * span)
+                        error_y = pos[1] - (last_pos[1] + last_velocity[1] * span)
+                        speed = max(speed, (error_x ** 2 + error_y ** 2) ** 0.5 / span)
+
+                    pending = [frame]
+                    last_index, last_pos, last_velocity = index, pos, velocity
+                    next_index = index + interval.next_interval(speed)
+
+            elif last_pos is not None:
+                pending.append(frame)
+
+            else:
+                # 惑星を見失っている間は書き出さない
+                yield CropChunk(index, [frame], None, [None])
+
+            index += 1
+
+    # 最後のチェック以降のフレーム
+    if last_pos is not None and len(pending) != 0:
+        yield hold_pending()
+
+# threaded_iter の終端・例外の目印
+_PIPELINE_END = object()
+
+class _PipelineError:
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+def threaded_iter(iterable, maxsize):
+    """
+    iterable を別スレッドで回し、サイズ maxsize の有界キュー経由で順番通りに返すジェネレータ
+    ステージごとに重ねることで、デコード・検出・書き出しを並行に実行できる
+    OpenCV の処理中は GIL が解放されるため、スレッドでも複数コアを使える
+    """
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # 受け取り側が終了したら諦める
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_PipelineError(e))
+        finally:
+            # 上流のジェネレータ(別ステージ)も止める
+            if hasattr(iterable, "close"):
+                iterable.close()
+            put(_PIPELINE_END)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, _PipelineError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def close_pipeline(*stages):
+    """
+    パイプラインのステージ (ジェネレータ) を下流から順に閉じる
+    threaded_iter のステージは閉じるとワーカースレッドの終了を待つので、
+    その後なら入力動画を release しても、デコード中の read() と重ならない
+    """
+    for stage in stages:
+        if stage is not None:
+            stage.close()
+
+class AviWriter:
+    """
+    cv2.VideoWriter による AVI(RAW) の書き出し (SerWriter と同じ使い方ができる)
+    """
+    def __init__(self, path: pathlib.Path, width, height, fps) -> None:
+        fourcc = cv2.VideoWriter_fourcc(*"RAW ")
+        self.writer = cv2.VideoWriter(str(path), fourcc, fps, (width, height))
+
+    def isOpened(self):
+        return self.writer.isOpened()
+
+    def write(self, img, timestamp=None):
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        self.writer.write(img)
+
+    def release(self):
+        self.writer.release()
+
+# 出力形式ごとの拡張子
+OUTPUT_SUFFIXES = {
+    "avi": ".avi",
+    "ser": ".ser",
+}
+
+def temp_output_path(outfile_path: pathlib.Path):
+    """
+    書き出し中の一時ファイル (完了してから outfile_path に名前を変えるので、途中で止まっても書きかけの出力は残らない)
+    cv2.VideoWriter は拡張子で形式を決めるので、拡張子はそのまま残す
+    """
+    return outfile_path.with_name(outfile_path.stem + ".tmp" + outfile_path.suffix)
+
+def finish_output(temp_path: pathlib.Path, outfile_path: pathlib.Path, completed):
+    """
+    書き出しが完了していれば一時ファイルを出力ファイルに置き換え、完了していなければ一時ファイルを削除する
+    """
+    if completed:
+        os.replace(str(temp_path), str(outfile_path))
+    elif temp_path.exists():
+        temp_path.unlink()
+
+def open_writer(outfile_path: pathlib.Path, output_format, crop_size, fps, ser_mode="mono8", start_time=None):
+    """
+    出力形式に合わせて書き出し先を開く
+    """
+    if output_format == "avi":
+        return AviWriter(outfile_path, crop_size, crop_size, fps)
+    elif output_format == "ser":
+        return ser_file.SerWriter(outfile_path, crop_size, crop_size, ser_mode, start_time)
+    else:
+        raise ValueError("unknown output format: %s" % output_format)
+
+# 入力動画のデコーダ
+DECODERS = ("opencv", "ffmpeg")
+
+def open_capture(infile_path: pathlib.Path, decoder="opencv", gray=False, start_frame=0):
+    """
+    入力動画を開き、cv2.VideoCapture と同じ使い方ができるものを返す
+    decoder が "ffmpeg" なら ffmpeg のサブプロセスでデコードする (ffmpeg がなければ OpenCV を使う)
+    ffmpeg は gray が True なら輝度のみのフレームを、そうでなければ I420Frame を出力する
+    (検出は輝度で行い、BGR への変換は切り抜く範囲だけにするため)
+    start_frame を指定すると、そのフレームから読み込む
+    """
+    if decoder == "ffmpeg":
+        if ffmpeg_capture.ffmpeg_available():
+            try:
+                return ffmpeg_capture.FfmpegCapture(infile_path, "gray" if gray else "yuvj420p", start_frame=start_frame)
+            except ValueError:
+                # 幅・高さが奇数で YUV420 にできない
+                return ffmpeg_capture.FfmpegCapture(infile_path, "bgr24", start_frame=start_frame)
+        print("ffmpeg not found, using OpenCV")
+    elif decoder != "opencv":
+        raise ValueError("unknown decoder: %s" % decoder)
+    capture = cv2.VideoCapture(str(infile_path))
+    if start_frame > 0 and capture.isOpened():
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    return capture
+
+def open_crop_movie(path: pathlib.Path):
+    """
+    切り抜き結果の SER / AVI(RAW) をメモリマップで開く
+    reader[i] でフレーム番号を指定して、コピーなしで読み込める
+    非圧縮でない (メモリマップで読めない) 場合は None を返す
+    """
+    suffix = path.suffix.lower()
+    try:
+        if suffix == ".ser":
+            return ser_file.SerReader(path)
+        elif suffix == ".avi":
+            return avi_file.RawAviReader(path)
+    except ValueError:
+        pass
+    return None
+
+def score_crop_movie(path: pathlib.Path, save_path: pathlib.Path):
+    """
+    切り抜き結果の全フレームの鮮鋭度を計算し、CSV に保存する (2回目の選別用)
+    """
+    reader = open_crop_movie(path)
+    if reader is None:
+        raise ValueError("not a raw movie: %s" % path)
+
+    try:
+        with open(str(save_path), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "score"])
+            for index in range(len(reader)):
+                writer.writerow([index, calc_sharpness(reader[index])])
+    finally:
+        reader.close()
+
+def estimate_start_time(infile_path: pathlib.Path, frames_all, fps):
+    """
+    撮影開始時刻を推定する (更新日時 = 録画終了時刻 とみなして録画時間を引く)
+    """
+    mtime = datetime.datetime.fromtimestamp(infile_path.stat().st_mtime).astimezone()
+    if fps <= 0:
+        return mtime
+    return mtime - datetime.timedelta(seconds=frames_all / fps)
+
+def frame_time_func(start_time, fps):
+    """
+    フレームの番号から撮影時刻を返す関数を作る (fps が分からなければ、全フレーム start_time にする)
+    """
+    def frame_time(index):
+        if fps <= 0:
+            return start_time
+        return start_time + datetime.timedelta(seconds=index / fps)
+    return frame_time
+
+def is_gray_output(output_format, ser_mode):
+    """
+    輝度だけを書き出すかどうか (MONO の SER に出力する場合)
+    """
+    return output_format == "ser" and ser_file.SER_MODES[ser_mode][1] == 1
+
+def open_output(outfile_path: pathlib.Path, output_format, crop_size, fps, ser_mode="mono8", start_time=None):
+    """
+    outfile_path の一時ファイル (temp_output_path) を書き出し先として開き、(書き出し先, 一時ファイル) を返す
+    開けなければ IOError にする
+    """
+    temp_path = temp_output_path(outfile_path)
+    outmovie = open_writer(temp_path, output_format, crop_size, fps, ser_mode, start_time)
+    if not outmovie.isOpened():
+        raise IOError("outmovie error: %s" % outfile_path)
+    return outmovie, temp_path
+
+def close_output(outmovie, temp_path: pathlib.Path, outfile_path: pathlib.Path, completed):
+    """
+    書き出し先を閉じ、完了していれば一時ファイルを出力ファイルに置き換える (finish_output を参照)
+    """
+    outmovie.release()
+    finish_output(temp_path, outfile_path, completed)
+
+def write_selected(selector, outmovie, frame_time, stats, scores_path: pathlib.Path) -> int:
+    """
+    選別したフレームを元の順番で書き出し、全フレームのスコアを scores_path に保存する
+    書き出したフレーム数を返す
+    """
+    written = 0
+    for index, frame in selector.selected():
+        t0 = time.perf_counter()
+        outmovie.write(frame, frame_time(index))
+        stats.add("write", time.perf_counter() - t0)
+        written += 1
+    selector.save_scores(scores_path)
+    return written
+
+class CropSegment(typing.NamedTuple):
+    """
+    1つの動画を区間に分けて並列に切り抜くときの1区間
+    """
+    # 最初のフレームの番号と、最後のフレームの次の番号
+    start: int
+    end: int
+    # 区間の切り抜き結果 (SER) の保存先
+    part_path: pathlib.Path
+    # 前の区間から引き継ぐ検出結果 (区間の先頭を含むウィンドウの先頭フレーム、
+    # 先頭がウィンドウの境界なら直前のフレームでの検出結果。引き継がない場合は None)
+    seed: typing.Optional[Detection] = None
+
+def split_segments(frames_all, segment_count, keyframes=None):
+    """
+    [0, frames_all) をおよそ segment_count 等分し、区間の (最初のフレームの番号, 最後の次の番号) のリストを返す
+    keyframes (キーフレームの番号のリスト) を指定すると、分割位置をそれぞれ一番近いキーフレームにずらす
+    (区間の先頭にシークしたとき、余分なデコードが少なくなるように)
+    """
+    bounds = set()
+    for k in range(1, segment_count):
+        bound = round(frames_all * k / segment_count)
+        if keyframes:
+            i = bisect.bisect_left(keyframes, bound)
+            bound = min(keyframes[max(i - 1, 0) : i + 1], key=lambda index: abs(index - bound))
+        if 0 < bound < frames_all:
+            bounds.add(bound)
+    points = [0] + sorted(bounds) + [frames_all]
+    return list(zip(points[:-1], points[1:]))
+
+def detect_segment_seeds(infile_path: pathlib.Path, starts, detector, crop_size, count):
+    """
+    各区間の先頭で引き継ぐ検出結果 (CropSegment.seed) を、区間の前のフレームにシークして検出する
+    区間の先頭がウィンドウの途中なら、そのウィンドウの先頭フレームで検出する (1つのプロセスで処理した場合と同じ結果になる)
+    "roi" は直前のフレームの重心から探索を始められるよう、ウィンドウの境界でも直前のフレームで検出する
+    """
+    # "roi" の最初の検出はフレーム全体で行うので、フレーム全体で検出しておく
+    seed_detector = FullFrameDetector() if detector == "roi" else create_detector(detector, crop_size)
+    capture = cv2.VideoCapture(str(infile_path))
+    seeds = []
+    try:
+        for start in starts:
+            seed = None
+            if start > 0 and (start % count != 0 or detector == "roi"):
+                index = start - start % count if start % count != 0 else start - 1
+                capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+                ret, frame = capture.read()
+                if ret:
+                    seed = seed_detector.detect(frame, index)
+            seeds.append(seed)
+    finally:
+        capture.release()
+    return seeds
+
+def main_cropping(infile_path: pathlib.Path, crop_size, threaded=False, queue_size=4, detector="full", count=None, adaptive=False,
+                  keep_count=None, keep_percent=None, output_format="avi", ser_mode="mono8", use_track=True, plot=False,
+                  on_progress=None, decoder="opencv", target_sizes=None, segments=None, max_workers=None,
+                  checkpoint=False, segment: CropSegment = None) -> dict:
+    """
+    動画から惑星を切り抜いて AVI(RAW) に保存する
+
+    threaded が True の場合、デコード・検出・書き出しを別スレッドのステージで実行する
+    ステージ間のキューは queue_size ウィンドウ分までに制限する
+    detector は検出方式 ("full": 毎回フレーム全体, "roi": 前回の重心周辺のみ,
+    "batch": ウィンドウの全フレームをまとめて検出し、フレームごとの重心で切り抜く)
+    count は切り抜く座標をチェックするフレーム間隔 (None なら検出方式ごとの既定値)
+    adaptive が True の場合、チェック間隔を重心の移動速度に合わせて変え、間のフレームは位置を補間する
+    (count は最初の間隔になる。"batch" は全フレームを検出するので使わない)
+    keep_count / keep_percent を指定した場合、鮮鋭度の上位 keep_count 枚 / keep_percent %のフレームだけを書き出し、
+    全フレームのスコアを "_crop_scores.csv" に保存する
+    output_format は出力形式 ("avi": AVI(RAW), "ser": SER)
+    ser_mode は SER の画素形式 ("mono8", "mono16", "rgb8", "rgb16")
+    use_track が True の場合、同じ検出方式で保存済みのトラック ("_track.npz") があれば検出を省略してそれを使い、
+    なければ検出結果をトラックとして保存する
+    plot が True の場合、トラックの重心座標の推移を "_track.png" に保存する
+    on_progress を指定すると、書き出しステージでまとまりを処理するたびに on_progress(stats: CropStats) を呼ぶ
+    (None なら進捗を表示する)
+    decoder は入力動画のデコーダ ("opencv": cv2.VideoCapture, "ffmpeg": ffmpeg のサブプロセス)
+    ffmpeg で MONO の SER に出力する場合は、デコード時に輝度だけを取り出す
+    それ以外は YUV420 のままデコードし、検出は輝度で行い、切り抜いた範囲だけを BGR に変換する
+    target_sizes (対象ごとの切り抜きサイズのリスト) を指定した場合、複数の対象を別々のファイルに切り抜く
+    (main_cropping_targets を参照。crop_size, detector, adaptive, use_track, plot は使わない)
+    segments を指定した場合、1つの動画を segments 個 (0 なら CPU コア数) の区間に分け、
+    max_workers 個のプロセスで並列に切り抜く (main_cropping_segmented を参照。target_sizes とは同時に使えない)
+    checkpoint が True の場合、区間に分けて切り抜き、終わった区間をチェックポイントに記録して、中断しても途中から再開できるようにする
+    (segments を指定しなければ CPU コア数の区間に分ける。main_cropping_segmented を参照)
+    出力は一時ファイルに書き出し、最後まで書き出せた場合だけ出力ファイルに置き換える
+    segment は main_cropping_segmented のワーカーで使う (区間だけを切り抜き、segment.part_path に保存する)
+
+    処理ごとの時間とフレーム数の集計 (CropStats.summary()) を返す
+    """
+    check_keep_options(keep_count, keep_percent)
+    if (checkpoint or segments is not None and segments != 1) and segment is None:
+        if target_sizes is not None:
+            raise ValueError("segments and checkpoint cannot be used with target_sizes")
+        return main_cropping_segmented(infile_path, crop_size, segments=segments, max_workers=max_workers,
+                                       threaded=threaded, queue_size=queue_size, detector=detector, count=count,
+                                       adaptive=adaptive, keep_count=keep_count, keep_percent=keep_percent,
+                                       output_format=output_format, ser_mode=ser_mode, use_track=use_track,
+                                       plot=plot, on_progress=on_progress, decoder=decoder, checkpoint=checkpoint)
+    if target_sizes is not None:
+        return main_cropping_targets(infile_path, target_sizes, threaded=threaded, queue_size=queue_size, count=count,
+                                     keep_count=keep_count, keep_percent=keep_percent, output_format=output_format,
+                                     ser_mode=ser_mode, on_progress=on_progress, decoder=decoder)
+
+    if segment is None:
+        outfile_path = infile_path.parent / (infile_path.stem + "_crop" + OUTPUT_SUFFIXES[output_format])
+        start, end = 0, None
+    else:
+        outfile_path = segment.part_path
+        start, end = segment.start, segment.end
 
     # ファイル読み込み
-    inmovie = cv2.VideoCapture(str(infile_path))
+    gray = is_gray_output(output_format, ser_mode)
+    inmovie = open_capture(infile_path, decoder, gray, start)
     if not inmovie.isOpened():
-        print("inmovie error")
-        sys.exit()
+        raise IOError("inmovie error: %s" % infile_path)
     width = int(inmovie.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(inmovie.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
     # ファイル書き出し
-    fourcc = cv2.VideoWriter_fourcc(*"RAW ")
-    size = (crop_size, crop_size)
-
-    outmovie = cv2.VideoWriter(str(outfile_path), fourcc, inmovie.get(cv2.CAP_PROP_FPS), size)
-    if not outmovie.isOpened():
-        print("outmovie error")
-        sys.exit()
+    fps = inmovie.get(cv2.CAP_PROP_FPS)
+    frames_all = int(inmovie.get(cv2.CAP_PROP_FRAME_COUNT))
+    start_time = estimate_start_time(infile_path, frames_all, fps)
+    frame_time = frame_time_func(start_time, fps)
 
-    # # 1枚試し処理
-    # ret, frame = movie.read()
-    # grey_img = preprocess(frame)
+    try:
+        outmovie, temp_path = open_output(outfile_path, output_format, crop_size, fps, ser_mode, start_time)
+    except:
+        inmovie.release()
+        raise
 
-    # print(calc_white_rate(grey_img))
+    stats = CropStats(frames_all if end is None else end - start)
+    # 書き出したフレームの番号
+    written_frames = []
+    selector = None
+    windows = planned = None
+    completed = False
 
     try:
         # 何枚に1回、切り抜く座標をチェックするかどうか
-        count = 10
-        # 総フレーム数
-        frames_all = int(inmovie.get(cv2.CAP_PROP_FRAME_COUNT))
-        # 座標リスト
-        moment_pos_list = []
-        
-        # count フレームごとに確認する
-        for i in range(0, frames_all, count):
-            
-            # 再生フレームの指定
-            inmovie.set(cv2.CAP_PROP_FRAME_COUNT, i)
-            print(i, "/", frames_all)
-
-            # フレーム取得
-            ret, frame = inmovie.read()
-            if not ret:
-                # 再生終了
-                break
-            
-            # 前処理
-            img = preprocess(frame)
-            # cv2.imshow("preprocess", img)
-            # cv2.waitKey(10)
+        if count is None:
+            count = DETECTOR_INTERVALS[detector]
+        # 惑星の検出器 (同じ設定で保存したトラックがあれば再利用する)
+        track = DetectionTrack.load(infile_path, detector, count, adaptive, decoder) if use_track else None
+        if track is not None:
+            planet_detector = TrackDetector(track)
+            new_track = None
+        else:
+            planet_detector = create_detector(detector, crop_size)
+            new_track = DetectionTrack()
+        planet_detector.stats = stats
+        if segment is not None and segment.seed is not None:
+            # 前の区間からの検出状態の引き継ぎ
+            if isinstance(planet_detector, RoiTrackingDetector):
+                planet_detector.last_pos = segment.seed.pos
+            if start % count != 0:
+                planet_detector = SeededDetector(planet_detector, start, segment.seed)
+        # フレーム選別
+        keep_count = resolve_keep_count(keep_count, keep_percent, frames_all)
+        if keep_count is not None:
+            selector = FrameSelector(keep_count, outfile_path.parent)
+
+        # 各フレームは1回だけデコードし、count フレームごとのウィンドウで処理する
+        frames = read_frames(inmovie, stats)
+        if end is not None:
+            frames = itertools.islice(frames, end - start)
+        windows = iter_frame_windows(frames, count, start)
+        if threaded:
+            # デコードステージ
+            windows = threaded_iter(windows, queue_size)
+
+        if detector == "batch":
+            # ウィンドウの全フレームをまとめて検出
+            planned = plan_batch_crops(windows, planet_detector, width, height, crop_size, new_track, stats, start)
+        elif adaptive:
+            # 移動速度に合わせた間隔で検出
+            interval = AdaptiveInterval(crop_size, initial_interval=count)
+            planned = plan_adaptive_crops(windows, planet_detector, width, height, crop_size, interval, new_track, stats,
+                                          start)
+        else:
+            # ウィンドウ先頭のフレームで検出
+            planned = plan_crop_windows(windows, planet_detector, width, height, crop_size, new_track, stats, start)
+        if threaded:
+            # 検出ステージ
+            planned = threaded_iter(planned, queue_size)
+
+        # 書き出しステージ (このスレッド)
+        for chunk in planned:
+            stats.frames_done = chunk.start + len(chunk.frames) - start
+            if on_progress is None:
+                print(chunk.start, "/", frames_all)
 
             # 惑星写ってなかったら1回おやすみ
-            if not exists_planets(img):
+            if chunk.pos is None:
+                stats.frames_no_planet += len(chunk.frames)
+                if on_progress is not None:
+                    on_progress(stats)
                 continue
 
-            # 重心計算
-            x, y = calc_moment(img)
-            moment_pos_list.append([x, y])
-
-            # 切り出しサイズ決定
-            x1, x2, y1, y2 = calc_crop_range(width, height, x, y, crop_size)
-            
             # 保存
-            # 再生フレームを count フレームごとの始めに戻す
-            inmovie.set(cv2.CAP_PROP_FRAME_COUNT, i)
-            for j in range(count):
-                
-                ret, frame = inmovie.read()
-                if not ret:  # 格納されてなかったら
-                    break
+            for j, (frame, crop_range) in enumerate(zip(chunk.frames, chunk.ranges)):
+                if crop_range is None:
+                    stats.frames_no_planet += 1
+                    continue
+                t0 = time.perf_counter()
+                frame = crop_frame(frame, crop_range, gray)
+                if selector is None:
+                    t1 = time.perf_counter()
+                    outmovie.write(frame, frame_time(chunk.start + j))
+                    stats.add("crop", t1 - t0)
+                    stats.add("write", time.perf_counter() - t1)
+                    stats.frames_written += 1
+                    written_frames.append(chunk.start + j)
+                else:
+                    selector.add(chunk.start + j, frame)
+                    stats.add("crop", time.perf_counter() - t0)
 
-                # print((i + j), x1, x2, y1, y2)
+            if on_progress is not None:
+                on_progress(stats)
 
-                frame = frame[y1 : y2, x1 : x2]
-                outmovie.write(frame)
+        # 1フレームも読めなければ、空の出力を残さずに失敗にする
+        if stats.frames_read == 0:
+            raise IOError("no frames decoded: %s" % infile_path)
 
-        #重心履歴の可視化
-        # moment_pos_list = np.array(moment_pos_list)
-
-        # plt.scatter(moment_pos_list[:,0], moment_pos_list[:,1],color='red', linestyle='solid', linewidth = 2.0, label='moment')
-        # plt.xlabel('x', color='black', fontsize=14)
-        # plt.ylabel('y', color='black', fontsize=14)
-        # plt.savefig('moment.jpg', dpi=300)
-        
-    except ZeroDivisionError:
-        pass
+        # 選別したフレームを元の順番で保存
+        if selector is not None:
+            stats.frames_written += write_selected(selector, outmovie, frame_time, stats,
+                                                   infile_path.parent / (infile_path.stem + "_crop_scores.csv"))
+            stats.frames_dropped = stats.counts["crop"] - stats.frames_written
+
+        if segment is None:
+            # 検出結果の保存
+            if new_track is not None:
+                if use_track:
+                    new_track.save(infile_path, detector, count, adaptive, decoder)
+                track = new_track
+
+            #重心履歴の可視化
+            if plot:
+                plot_track(track, infile_path.parent / (infile_path.stem + "_track.png"))
+        completed = True
 
     except:
         traceback.print_exc()
+        raise
 
     finally:
-        outmovie.release()
+        # デコード・検出のスレッドを止めてから入力動画を閉じる
+        close_pipeline(planned, windows)
+        inmovie.release()
+        if selector is not None:
+            selector.close()
+        close_output(outmovie, temp_path, outfile_path, completed)
+
+    summary = stats.summary()
+    if segment is not None:
+        # 区間の処理では、検出結果と書き出したフレームの番号を呼び出し元でまとめる
+        summary["track"] = new_track
+        summary["frames"] = written_frames
+    return summary
+
+def target_outfile_path(infile_path: pathlib.Path, target, output_format):
+    """
+    複数対象の切り抜きの出力ファイル (対象 0 は1対象のときと同じ名前)
+    """
+    suffix = "_crop" if target == 0 else "_crop_t%d" % target
+    return infile_path.parent / (infile_path.stem + suffix + OUTPUT_SUFFIXES[output_format])
+
+def main_cropping_targets(infile_path: pathlib.Path, target_sizes, threaded=False, queue_size=4, count=None,
+                          keep_count=None, keep_percent=None, output_format="avi", ser_mode="mono8",
+                          on_progress=None, decoder="opencv", min_area=MIN_TARGET_AREA) -> dict:
+    """
+    動画から複数の対象 (惑星と衛星など) を1回のデコードで切り抜き、対象ごとに別のファイルに保存する
+
+    target_sizes: 対象ごとの切り抜きサイズ (対象の番号は捕捉したときの大きさの順)
+    対象は TARGET_CONFIRM_CHECKS 回のチェックで続けて写ったら捕捉し、最初に写ったウィンドウから切り抜く (plan_target_crops を参照)
+    対象 0 は "_crop"、対象 i は "_crop_t<i>" に保存する (一度も捕捉しなかった対象のファイルは作らない)
+    count は切り抜く座標をチェックするフレーム間隔 (None なら "full" と同じ)
+    keep_count / keep_percent は対象ごとに適用し、スコアは "_crop_scores.csv" / "_crop_t<i>_scores.csv" に保存する
+    その他の引数は main_cropping と同じ
+
+    集計 (CropStats.summary()) に、対象ごとの出力ファイルと書き出したフレーム数 ("targets") を加えて返す
+    """
+    # ファイル読み込み
+    gray = is_gray_output(output_format, ser_mode)
+    inmovie = open_capture(infile_path, decoder, gray)
+    if not inmovie.isOpened():
+        raise IOError("inmovie error: %s" % infile_path)
+    width = int(inmovie.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(inmovie.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = inmovie.get(cv2.CAP_PROP_FPS)
+    frames_all = int(inmovie.get(cv2.CAP_PROP_FRAME_COUNT))
+    start_time = estimate_start_time(infile_path, frames_all, fps)
+    frame_time = frame_time_func(start_time, fps)
+
+    stats = CropStats(frames_all)
+    target_count = len(target_sizes)
+    # 対象ごとの出力と一時ファイル (最初に写ったときに開く)
+    outmovies = [None] * target_count
+    temp_paths = [None] * target_count
+    written = [0] * target_count
+
+    def get_outmovie(target):
+        if outmovies[target] is None:
+            outmovies[target], temp_paths[target] = open_output(target_outfile_path(infile_path, target, output_format),
+                                                                output_format, target_sizes[target], fps, ser_mode,
+                                                                start_time)
+        return outmovies[target]
+
+    # フレーム選別 (対象ごと)
+    selectors = [None] * target_count
+    windows = planned = None
+    completed = False
+    try:
+        if count is None:
+            count = DETECTOR_INTERVALS["full"]
+        keep_count = resolve_keep_count(keep_count, keep_percent, frames_all)
+        if keep_count is not None:
+            selectors = [FrameSelector(keep_count, infile_path.parent) for target in range(target_count)]
+
+        # 各フレームは1回だけデコードし、count フレームごとのウィンドウで処理する
+        windows = iter_frame_windows(read_frames(inmovie, stats), count)
+        if threaded:
+            windows = threaded_iter(windows, queue_size)
+        # 各対象は切り抜き枠の半分以上離れたら別の物体とみなす
+        tracker = TargetTracker([size / 2 for size in target_sizes])
+        planned = plan_target_crops(windows, tracker, width, height, target_sizes, min_area, stats)
+        if threaded:
+            planned = threaded_iter(planned, queue_size)
+
+        # 書き出しステージ (このスレッド)
+        for chunk in planned:
+            stats.frames_done = chunk.start + len(chunk.frames)
+            if on_progress is None:
+                print(chunk.start, "/", frames_all)
+            if all(pos is None for pos in chunk.positions):
+                stats.frames_no_planet += len(chunk.frames)
+
+            for target, ranges in enumerate(chunk.ranges):
+                for j, (frame, crop_range) in enumerate(zip(chunk.frames, ranges)):
+                    if crop_range is None:
+                        continue
+                    t0 = time.perf_counter()
+                    frame = crop_frame(frame, crop_range, gray)
+                    if selectors[target] is None:
+                        outmovie = get_outmovie(target)
+                        t1 = time.perf_counter()
+                        outmovie.write(frame, frame_time(chunk.start + j))
+                        stats.add("crop", t1 - t0)
+                        stats.add("write", time.perf_counter() - t1)
+                        stats.frames_written += 1
+                        written[target] += 1
+                    else:
+                        selectors[target].add(chunk.start + j, frame)
+                        stats.add("crop", time.perf_counter() - t0)
+
+            if on_progress is not None:
+                on_progress(stats)
+
+        # 1フレームも読めなければ失敗にする
+        if stats.frames_read == 0:
+            raise IOError("no frames decoded: %s" % infile_path)
+
+        # 選別したフレームを元の順番で保存
+        for target, selector in enumerate(selectors):
+            if selector is None or len(selector.scores) == 0:
+                continue
+            outfile_path = target_outfile_path(infile_path, target, output_format)
+            n = write_selected(selector, get_outmovie(target), frame_time, stats,
+                               outfile_path.parent / (outfile_path.stem + "_scores.csv"))
+            stats.frames_written += n
+            written[target] += n
+        if keep_count is not None:
+            stats.frames_dropped = stats.counts["crop"] - stats.frames_written
+        completed = True
+
+    except:
+        traceback.print_exc()
+        raise
+
+    finally:
+        # デコード・検出のスレッドを止めてから入力動画を閉じる
+        close_pipeline(planned, windows)
+        inmovie.release()
+        for selector in selectors:
+            if selector is not None:
+                selector.close()
+        for target, outmovie in enumerate(outmovies):
+            if outmovie is not None:
+                close_output(outmovie, temp_paths[target], target_outfile_path(infile_path, target, output_format),
+                             completed)
+
+    summary = stats.summary()
+    summary["targets"] = [
+        {
+            "crop_size": target_sizes[target],
+            "path": str(target_outfile_path(infile_path, target, output_format)) if outmovies[target] is not None else None,
+            "frames_written": written[target],
+        }
+        for target in range(target_count)
+    ]
+    return summary
+
+# バッチ処理で進捗を送る間隔 [s]
+PROGRESS_INTERVAL = 0.5
+
+def _batch_cropping_job(index, infile_path, crop_size, options, progress_queue=None):
+    """
+    プロセスプールのワーカーで実行する1ジョブ分の処理
+    progress_queue を指定すると、PROGRESS_INTERVAL ごとに (index, 集計) を送る
+    """
+    on_progress = None
+    if progress_queue is not None:
+        last_time = 0.0
+
+        def on_progress(stats):
+            nonlocal last_time
+            now = time.perf_counter()
+            if now - last_time >= PROGRESS_INTERVAL:
+                last_time = now
+                progress_queue.put((index, stats.summary()))
+
+    return main_cropping(infile_path, crop_size, on_progress=on_progress, **options)
+
+def batch_cropping(jobs, max_workers=None, on_job_done=None, on_progress=None, **options):
+    """
+    (動画パス, 切り抜きサイズ[, ジョブごとのオプション]) のジョブのリストを、プロセスプールで並列に切り抜く
+
+    max_workers: ワーカープロセス数 (None なら CPU コア数)
+    on_job_done: ジョブが終わるたびに on_job_done(index, infile_path, error, summary) を呼ぶ
+                 index は jobs 内の位置、error は成功なら None、失敗なら例外
+                 summary は main_cropping が返した集計 (失敗なら None)
+    on_progress: 処理中のジョブの進捗を on_progress(index, infile_path, summary) で受け取る
+                 (ワーカーから Manager のキュー経由で送る)
+    options: main_cropping にそのまま渡すオプション (ジョブごとのオプションがあれば、そちらを優先する)
+
+    失敗したジョブの (index, 例外) のリストを返す
+    """
+    errors = []
+    manager = multiprocessing.Manager() if on_progress is not None else None
+    progress_queue = manager.Queue() if manager is not None else None
+
+    def drain_progress():
+        while progress_queue is not None:
+            try:
+                index, summary = progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            on_progress(index, jobs[index][0], summary)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict()
+            for index, job in enumerate(jobs):
+                infile_path, crop_size = job[:2]
+                job_options = dict(options, **job[2]) if len(job) > 2 else options
+                future = executor.submit(_batch_cropping_job, index, pathlib.Path(infile_path), crop_size, job_options,
+                                         progress_queue)
+                futures[future] = index
+
+            # 進捗を受け取りながら、終わった順に通知
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=PROGRESS_INTERVAL,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                drain_progress()
+                for future in done:
+                    index = futures[future]
+                    error = future.exception()
+                    summary = None
+                    if error is not None:
+                        errors.append((index, error))
+                    else:
+                        summary = future.result()
+                    if on_job_done is not None:
+                        on_job_done(index, jobs[index][0], error, summary)
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+    errors.sort(key=lambda e: e[0])
+    return errors
+
+# 途中から再開できるように切り抜く場合の、1区間の最大フレーム数 (中断したときにやり直すのは、処理中の区間のみ)
+CHECKPOINT_FRAMES = 2000
+# チェックポイントのファイル名
+CHECKPOINT_NAME = "checkpoint.json"
+
+def checkpoint_dir(infile_path: pathlib.Path):
+    """
+    途中から再開できるように切り抜く場合の、区間ごとの切り抜き結果とチェックポイントの保存先
+    """
+    return infile_path.parent / (infile_path.stem + "_crop_parts")
+
+def detection_to_list(detection: Detection):
+    """
+    Detection を JSON に保存できる形にする
+    """
+    return [bool(detection.present), int(detection.x), int(detection.y),
+            float(detection.white_rate), float(detection.threshold)]
+
+def read_checkpoint(path: pathlib.Path):
+    """
+    チェックポイントを読み込む (ない場合や壊れている場合は None)
+    """
+    try:
+        with open(str(path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_checkpoint(path: pathlib.Path, state: dict):
+    """
+    チェックポイントを一時ファイルに書いてから置き換える (書き込み中に止まっても前回の内容が残る)
+    """
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(str(temp_path), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(str(temp_path), str(path))
+
+def main_cropping_segmented(infile_path: pathlib.Path, crop_size, segments=None, max_workers=None, threaded=False,
+                            queue_size=4, detector="full", count=None, adaptive=False, keep_count=None,
+                            keep_percent=None, output_format="avi", ser_mode="mono8", use_track=True, plot=False,
+                            on_progress=None, decoder="opencv", checkpoint=False) -> dict:
+    """
+    1つの動画を区間に分け、区間ごとにプロセスプールで並列に切り抜いてから、1つのファイルにつなげる
+
+    segments: 区間の数 (None または 0 なら CPU コア数)。分割位置は ffprobe で調べたキーフレームにそろえる
+              (ffprobe がない場合などは均等に分ける)
+    max_workers: ワーカープロセス数 (None なら CPU コア数)
+    区間の境界ではウィンドウを分けず、区間の先頭を含むウィンドウの検出結果を親プロセスで求めて引き継ぐので、
+    "full", "batch" は1つのプロセスで処理した場合と同じ結果になる
+    ("roi" は直前のフレームの重心から探索を始める。adaptive の場合、チェック間隔は区間ごとに最初からやり直す)
+    各区間は非圧縮の SER で保存し、最後に順番につなげて書き出す
+    (SER への出力で選別しない場合、フレームデータとタイムスタンプはそのままコピーする)
+    keep_count / keep_percent による選別と、トラックの保存・可視化はつなげるときに全区間まとめて行う
+    checkpoint が True の場合、区間を CHECKPOINT_FRAMES フレーム以下に分け、区間の切り抜き結果を "_crop_parts" に残して、
+    終わった区間 (書き出したフレームの番号と検出結果) をチェックポイントに記録する
+    中断した後に同じ動画・設定で実行すると、終わっていない区間だけを切り抜いて再開する
+    on_progress には全区間の合計の CropStats を渡す
+    その他の引数は main_cropping と同じ
+
+    集計 (CropStats.summary()) に、区間の (最初のフレームの番号, 最後の次の番号) のリスト ("segments") を加えて返す
+    """
+    if not segments:
+        segments = multiprocessing.cpu_count()
+    if count is None:
+        count = DETECTOR_INTERVALS[detector]
+    outfile_path = infile_path.parent / (infile_path.stem + "_crop" + OUTPUT_SUFFIXES[output_format])
+
+    capture = cv2.VideoCapture(str(infile_path))
+    try:
+        if not capture.isOpened():
+            raise IOError("inmovie error: %s" % infile_path)
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frames_all = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+    start_time = estimate_start_time(infile_path, frames_all, fps)
+    frame_time = frame_time_func(start_time, fps)
+
+    # 区間の保存形式 (選別する場合は、1つのプロセスで処理した場合と同じく 8bit の画像でスコアを付ける)
+    gray = is_gray_output(output_format, ser_mode)
+    keep_count = resolve_keep_count(keep_count, keep_percent, frames_all)
+    if output_format == "ser" and keep_count is None:
+        part_mode = ser_mode
+    else:
+        part_mode = "mono8" if gray else "rgb8"
+
+    # 保存済みのトラック
+    track = DetectionTrack.load(infile_path, detector, count, adaptive, decoder) if use_track else None
+
+    # 前回のチェックポイント (動画か、区間の切り抜き結果が変わる設定が違えば使わない)
+    params = {"crop_size": crop_size, "detector": detector, "count": count, "adaptive": adaptive,
+              "ser_mode": part_mode, "decoder": decoder, "track": track is not None}
+    key = DetectionTrack.file_key(infile_path).tolist()
+    state = None
+    if checkpoint:
+        part_dir = checkpoint_dir(infile_path)
+        state = read_checkpoint(part_dir / CHECKPOINT_NAME)
+        if state is not None and (state["key"] != key or state["params"] != params):
+            state = None
+        if state is None:
+            shutil.rmtree(str(part_dir), ignore_errors=True)
+            part_dir.mkdir()
+        else:
+            print("resume:", infile_path, "(%d/%d segments done)" % (len(state["done"]), len(state["segments"])))
+    else:
+        part_dir = pathlib.Path(tempfile.mkdtemp(prefix=infile_path.stem + "_crop_", dir=str(infile_path.parent)))
+
+    if state is None:
+        # 区間の分割
+        if checkpoint:
+            segments = max(segments, math.ceil(frames_all / CHECKPOINT_FRAMES))
+        try:
+            keyframes = analyze_metadata.analyze_keyframes(infile_path)
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            keyframes = None
+        bounds = split_segments(frames_all, segments, keyframes)
+
+        # 区間の先頭で引き継ぐ検出結果 (保存済みのトラックを使う場合と、全フレームを検出する場合は不要)
+        if track is None and detector != "batch" and not adaptive:
+            seeds = detect_segment_seeds(infile_path, [start for start, end in bounds], detector, crop_size, count)
+        else:
+            seeds = [None] * len(bounds)
+        state = {
+            "key": key,
+            "params": params,
+            "segments": [[start, end, detection_to_list(seed) if seed is not None else None]
+                         for (start, end), seed in zip(bounds, seeds)],
+            "done": {},
+        }
+        if checkpoint:
+            write_checkpoint(part_dir / CHECKPOINT_NAME, state)
+
+    plan = [CropSegment(start, end, part_dir / ("part%03d.ser" % i), Detection(*seed) if seed is not None else None)
+            for i, (start, end, seed) in enumerate(state["segments"])]
+    bounds = [(segment.start, segment.end) for segment in plan]
+
+    # 区間ごとの結果 (チェックポイントに記録済みの区間は読み込む)
+    results = [None] * len(plan)
+    for i, done in state["done"].items():
+        summary = dict(done["summary"])
+        summary["frames"] = done["frames"]
+        summary["track"] = None
+        if done["track"] is not None:
+            summary["track"] = DetectionTrack()
+            for frame, *detection in done["track"]:
+                summary["track"].add(frame, Detection(*detection))
+        results[int(i)] = summary
+
+    stats = CropStats(frames_all)
+    completed = False
+    try:
+        # 区間ごとの切り抜き (終わっていない区間のみ)
+        pending = [i for i, summary in enumerate(results) if summary is None]
+        jobs = [(infile_path, crop_size, {"segment": plan[i]}) for i in pending]
+        progress = list(results)
+
+        def on_job_done(index, path, error, summary):
+            i = pending[index]
+            results[i] = summary
+            progress[i] = summary
+            if checkpoint and error is None:
+                state["done"][str(i)] = {
+                    "summary": {k: v for k, v in summary.items() if k not in ("frames", "track")},
+                    "frames": summary["frames"],
+                    "track": [[frame] + detection_to_list(detection)
+                              for frame, detection in zip(summary["track"].frames, summary["track"].detections)]
+                             if summary["track"] is not None else None,
+                }
+                write_checkpoint(part_dir / CHECKPOINT_NAME, state)
+
+        def on_segment_progress(index, path, summary):
+            progress[pending[index]] = summary
+            total = CropStats(frames_all)
+            for item in progress:
+                if item is not None:
+                    total.add_summary(item)
+            if on_progress is None:
+                print(total.frames_done, "/", frames_all)
+            else:
+                on_progress(total)
+
+        if len(jobs) != 0:
+            errors = batch_cropping(jobs, max_workers, on_job_done, on_segment_progress, threaded=threaded,
+                                    queue_size=queue_size, detector=detector, count=count, adaptive=adaptive,
+                                    output_format="ser", ser_mode=part_mode, use_track=use_track, decoder=decoder)
+            if len(errors) != 0:
+                raise errors[0][1]
+        for summary in results:
+            stats.add_summary(summary)
+
+        # 区間をつなげて書き出す
+        outmovie, temp_path = open_output(outfile_path, output_format, crop_size, fps, ser_mode, start_time)
+        selector = FrameSelector(keep_count, part_dir) if keep_count is not None else None
+        written = 0
+        written_all = False
+        try:
+            for segment, summary in zip(plan, results):
+                reader = ser_file.SerReader(segment.part_path)
+                try:
+                    for i, index in enumerate(summary["frames"]):
+                        t0 = time.perf_counter()
+                        if selector is not None:
+                            selector.add(index, reader[i])
+                            stats.add("crop", time.perf_counter() - t0)
+                            continue
+                        if output_format == "ser":
+                            outmovie.write_raw(reader[i], reader.timestamps[i])
+                        else:
+                            outmovie.write(reader[i], frame_time(index))
+                        stats.add("write", time.perf_counter() - t0)
+                        written += 1
+                finally:
+                    reader.close()
+
+            if selector is not None:
+                written += write_selected(selector, outmovie, frame_time, stats,
+                                          infile_path.parent / (infile_path.stem + "_crop_scores.csv"))
+            written_all = True
+        finally:
+            if selector is not None:
+                selector.close()
+            close_output(outmovie, temp_path, outfile_path, written_all)
+        stats.frames_dropped = stats.frames_written - written
+        stats.frames_written = written
+
+        # 検出結果の保存
+        if track is None:
+            track = DetectionTrack()
+            for summary in results:
+                if summary["track"] is not None:
+                    track.frames += summary["track"].frames
+                    track.detections += summary["track"].detections
+            if use_track:
+                track.save(infile_path, detector, count, adaptive, decoder)
+
+        #重心履歴の可視化
+        if plot:
+            plot_track(track, infile_path.parent / (infile_path.stem + "_track.png"))
+        completed = True
+    finally:
+        # チェックポイントは、最後まで書き出せなかった場合だけ残す
+        if completed or not checkpoint:
+            shutil.rmtree(str(part_dir), ignore_errors=True)
+
+    summary = stats.summary()
+    summary["segments"] = bounds
+    return summary
+
+def positive_int(value) -> int:
+    """
+    argparse の型: 1 以上の整数
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %s" % value)
+    return number
+
+def percent(value) -> float:
+    """
+    argparse の型: 0 より大きく 100 以下の割合 [%]
+    """
+    number = float(value)
+    if not (0 < number <= 100):
+        raise argparse.ArgumentTypeError("must be in (0, 100]: %s" % value)
+    return number
+
+def parse_bool(value) -> bool:
+    """
+    CSV の真偽値 ("1", "true", "yes" など) を bool にする
+    """
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+def parse_int_list(value) -> list:
+    """
+    CSV の空白区切りの整数 ("384 64 64") をリストにする
+    """
+    return [int(item) for item in str(value).split()]
+
+# ジョブ定義ファイルで指定できる main_cropping のオプションと、CSV の文字列からの変換
+MANIFEST_OPTIONS = {
+    "detector": str,
+    "count": int,
+    "adaptive": parse_bool,
+    "keep_count": int,
+    "keep_percent": float,
+    "output_format": str,
+    "ser_mode": str,
+    "use_track": parse_bool,
+    "plot": parse_bool,
+    "decoder": str,
+    "target_sizes": parse_int_list,
+}
+
+def load_job_manifest(manifest_path: pathlib.Path, crop_size=384) -> list:
+    """
+    ジョブ定義ファイル (JSON または CSV) を読み込み、(動画パス, 切り抜きサイズ, オプション) のリストを返す
+
+    JSON: ジョブのリスト (または {"jobs": [...]})
+          ジョブは動画パスの文字列か、{"path": 動画パス, "crop_size": 切り抜きサイズ, MANIFEST_OPTIONS のオプション} の dict
+    CSV: 1行目が列名 (path, crop_size, MANIFEST_OPTIONS のオプション) で、1行1ジョブ (空欄は指定なし)
+    相対パスはジョブ定義ファイルのあるフォルダからのパスとみなす
+    crop_size はジョブで指定しなかった場合の切り抜きサイズ
+    """
+    with open(str(manifest_path), encoding="utf-8", newline="") as f:
+        if manifest_path.suffix.lower() == ".csv":
+            rows = [{name: value for name, value in row.items() if value not in (None, "")} for row in csv.DictReader(f)]
+        else:
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows["jobs"]
+            rows = [{"path": row} if isinstance(row, str) else dict(row) for row in rows]
+
+    jobs = []
+    for row in rows:
+        if "path" not in row:
+            raise ValueError("job without path in %s: %r" % (manifest_path, row))
+        infile_path = pathlib.Path(row.pop("path"))
+        if not infile_path.is_absolute():
+            infile_path = manifest_path.parent / infile_path
+        size = int(row.pop("crop_size", crop_size))
+
+        unknown = set(row) - set(MANIFEST_OPTIONS)
+        if len(unknown) != 0:
+            raise ValueError("unknown job options in %s: %s" % (manifest_path, ", ".join(sorted(unknown))))
+        options = {name: MANIFEST_OPTIONS[name](value) if isinstance(value, str) else value
+                   for name, value in row.items()}
+        jobs.append((infile_path, size, options))
+    return jobs
+
+# 切り抜き結果に影響する設定 (切り抜きサイズと、main_cropping のこれらの引数)
+CROP_PARAM_NAMES = ["output_format", "ser_mode", "detector", "count", "adaptive", "keep_count", "keep_percent",
+                    "decoder", "target_sizes"]
+
+def crop_params(crop_size, options: dict) -> dict:
+    """
+    切り抜き結果に影響する設定 (options は main_cropping のキーワード引数)
+    """
+    params = {"crop_size": crop_size}
+    for name in CROP_PARAM_NAMES:
+        value = options.get(name)
+        params[name] = list(value) if isinstance(value, tuple) else value
+    return params
+
+def crop_params_path(infile_path: pathlib.Path):
+    """
+    切り抜いたときの設定の保存先 ("_crop.json")
+    """
+    return infile_path.parent / (infile_path.stem + "_crop.json")
+
+def save_crop_params(infile_path: pathlib.Path, params: dict):
+    """
+    切り抜いたときの入力動画 (サイズ, 更新日時) と設定を保存する (crop_output_up_to_date で比べる)
+    """
+    path = crop_params_path(infile_path)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(str(temp_path), "w", encoding="utf-8") as f:
+        json.dump({"key": DetectionTrack.file_key(infile_path).tolist(), "params": params}, f, indent=2)
+    os.replace(str(temp_path), str(path))
+
+def crop_output_up_to_date(infile_path: pathlib.Path, params: dict) -> bool:
+    """
+    切り抜き結果 ("_crop") が、同じ入力動画から同じ設定 (crop_params) で切り抜いたもので、
+    入力動画より新しく、中断したチェックポイントも残っていないか
+    (出力は最後まで書き出せた場合だけ置き換えるので、出力があれば完了している)
+    """
+    outfile_path = infile_path.parent / (infile_path.stem + "_crop" + OUTPUT_SUFFIXES[params["output_format"]])
+    if not outfile_path.exists() or checkpoint_dir(infile_path).exists():
+        return False
+    saved = read_checkpoint(crop_params_path(infile_path))
+    if saved is None or saved.get("params") != params or saved.get("key") != DetectionTrack.file_key(infile_path).tolist():
+        return False
+    return outfile_path.stat().st_mtime_ns >= infile_path.stat().st_mtime_ns
+
+def cui_main():
+    parser = argparse.ArgumentParser(description="惑星動画クロッピング")
+    parser.add_argument("movies", nargs="*", help="入力動画ファイル")
+    parser.add_argument("-m", "--manifest", type=pathlib.Path, default=None,
+                        help="ジョブ定義ファイル (JSON / CSV。動画ごとに切り抜きサイズやオプションを指定する)")
+    parser.add_argument("-s", "--crop-size", type=int, default=384, help="切り抜きサイズ")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="並列に処理するプロセス数")
+    parser.add_argument("--detector", choices=DETECTOR_INTERVALS.keys(), default="full", help="惑星の検出方式")
+    parser.add_argument("--interval", type=int, default=None, help="切り抜く座標をチェックするフレーム間隔")
+    parser.add_argument("--adaptive", action="store_true", help="チェック間隔を惑星の移動速度に合わせて変える")
+    parser.add_argument("--keep-count", type=positive_int, default=None, help="鮮鋭度の上位何枚を残すか")
+    parser.add_argument("--keep-percent", type=percent, default=None, help="鮮鋭度の上位何%%を残すか")
+    parser.add_argument("--format", choices=OUTPUT_SUFFIXES.keys(), default="avi", help="出力形式")
+    parser.add_argument("--ser-mode", choices=ser_file.SER_MODES.keys(), default="mono8", help="SER の画素形式")
+    parser.add_argument("--no-track", action="store_true", help="保存済みの検出結果 (トラック) を使わない")
+    parser.add_argument("--plot", action="store_true", help="重心座標の推移をグラフに保存する")
+    parser.add_argument("--profile", action="store_true", help="処理ごとの時間とフレーム数を表示する")
+    parser.add_argument("--decoder", choices=DECODERS, default="opencv", help="入力動画のデコーダ")
+    parser.add_argument("--target-sizes", type=int, nargs="+", default=None,
+                        help="複数の対象 (惑星と衛星など) を大きい順に別々のファイルに切り抜くときの、対象ごとの切り抜きサイズ")
+    parser.add_argument("--segments", type=int, default=None,
+                        help="1つの動画をいくつの区間に分けて並列に切り抜くか (0 なら CPU コア数。動画は1つずつ処理する)")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="終わった区間を記録し、中断しても次回は途中から再開する (動画は1つずつ処理する)")
+    parser.add_argument("--force", action="store_true",
+                        help="同じ設定で切り抜いた結果が入力動画より新しくても切り抜き直す")
+    args = parser.parse_args()
+
+    jobs = [(pathlib.Path(movie), args.crop_size, dict()) for movie in args.movies]
+    if args.manifest is not None:
+        jobs += load_job_manifest(args.manifest, args.crop_size)
+    if len(jobs) == 0:
+        parser.error("no movies or manifest specified")
+
+    options = dict(threaded=True, detector=args.detector, count=args.interval, adaptive=args.adaptive,
+                   keep_count=args.keep_count, keep_percent=args.keep_percent,
+                   output_format=args.format, ser_mode=args.ser_mode,
+                   use_track=not args.no_track, plot=args.plot, decoder=args.decoder,
+                   target_sizes=args.target_sizes)
+
+    # 同じ設定で切り抜いた結果が最新のジョブは飛ばす
+    if not args.force:
+        pending = []
+        for job in jobs:
+            infile_path, crop_size, job_options = job
+            if infile_path.exists() and crop_output_up_to_date(infile_path, crop_params(crop_size, dict(options, **job_options))):
+                print("skip:", infile_path)
+            else:
+                pending.append(job)
+        jobs = pending
+
+    def on_job_done(index, infile_path, error, summary):
+        if error is None:
+            print("done:", infile_path)
+            # 次回、同じ設定なら飛ばせるように設定を保存する
+            infile_path, crop_size, job_options = jobs[index]
+            save_crop_params(infile_path, crop_params(crop_size, dict(options, **job_options)))
+            if args.profile:
+                print(format_crop_summary(summary))
+        else:
+            print("error:", infile_path, repr(error))
+
+    if args.segments is None and not args.checkpoint:
+        errors = batch_cropping(jobs, max_workers=args.workers, on_job_done=on_job_done, **options)
+    else:
+        # 動画ごとに、区間に分けて全プロセスで切り抜く
+        errors = []
+        for index, (infile_path, crop_size, job_options) in enumerate(jobs):
+            try:
+                summary = main_cropping(infile_path, crop_size, segments=args.segments, max_workers=args.workers,
+                                        checkpoint=args.checkpoint, **dict(options, **job_options))
+            except Exception as e:
+                errors.append((index, e))
+                on_job_done(index, infile_path, e, None)
+            else:
+                on_job_done(index, infile_path, None, summary)
+    if len(errors) != 0:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    infile_pathstr = r"./test_data/P8130021.MOV"
-    infile_path = pathlib.Path(infile_pathstr)
-    main_cropping(infile_path, 384)
+    multiprocessing.freeze_support()
+    cui_main()
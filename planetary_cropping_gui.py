@@ -1,6 +1,15 @@
+import bisect
+import collections
+import concurrent.futures
 import enum
 import base64
+import json
+import multiprocessing
+import os
 import pathlib
+import subprocess
+import threading
+import time
 import traceback
 
 # third party
@@ -9,12 +18,14 @@ import cv2
 import numpy as np
 
 # self made
+import analyze_metadata
 import planetary_cropping as my
 
 class RecordStatus(enum.Enum):
     UNPROCESSED = (enum.auto(), "未処理")
     PROCESSING  = (enum.auto(), "処理中")
     PROCESSED   = (enum.auto(), "処理済み")
+    ERROR       = (enum.auto(), "エラー")
 
     def __init__(self, id, ja):
         self.id = id
@@ -27,36 +38,337 @@ class CropSize(enum.IntEnum):
     X384 = 384
     X512 = 512
     
+# プレビューの表示幅
+PREVIEW_WIDTH = 960
+
 class CvImage:
+    # データなし画像は1回だけ作って使い回す
+    nodata_cv_image = np.full((720, 1280), 128, dtype=np.uint8)
+    nodata_b64_image = None
+
     def __init__(self) -> None:
         pass
 
     def get_nodata_cv_image(self):
-        cv_image = np.empty((720, 1280))
-        cv_image.fill(128)
-        return cv_image
+        return self.nodata_cv_image
 
     def get_nodata_b64_image(self):
-        return self.cv_to_b64_image(self.get_nodata_cv_image())
+        if CvImage.nodata_b64_image is None:
+            CvImage.nodata_b64_image = self.cv_to_b64_image(self.get_nodata_cv_image(), PREVIEW_WIDTH)
+        return CvImage.nodata_b64_image
     
-    def cv_to_b64_image(self, cv_image):
+    def cv_to_b64_image(self, cv_image, width=None):
+        # 表示幅より大きければ縮小してからエンコードする
+        if width is not None and cv_image.shape[1] > width:
+            height = max(1, cv_image.shape[0] * width // cv_image.shape[1])
+            cv_image = cv2.resize(cv_image, (width, height), interpolation=cv2.INTER_AREA)
         _, encoded = cv2.imencode(".jpg", cv_image)
         b64_image = base64.b64encode(encoded).decode("ascii")
         return b64_image
 
+class FrameCache:
+    """
+    デコード済みフレームの LRU キャッシュ
+    保持するフレームの合計バイト数を max_bytes 以下に抑える
+    """
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.frames = collections.OrderedDict()
+
+    def get(self, index):
+        frame = self.frames.get(index)
+        if frame is not None:
+            self.frames.move_to_end(index)
+        return frame
+
+    def put(self, index, frame):
+        if index in self.frames:
+            self.nbytes -= self.frames.pop(index).nbytes
+        self.frames[index] = frame
+        self.nbytes += frame.nbytes
+
+        # 古いものから捨てる
+        while self.nbytes > self.max_bytes and len(self.frames) > 1:
+            old_index, old_frame = self.frames.popitem(last=False)
+            self.nbytes -= old_frame.nbytes
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+
+class VideoFrameSource:
+    """
+    フレーム番号を指定して動画を読み込む
+
+    キーフレームの位置はバックグラウンドで調べ、分かったら目的のフレームに最も近い手前のキーフレームからデコードする
+    調べ終わるまでは近ければ順に読み、遠ければ OpenCV のシークに任せる
+    現在位置から順に読むほうが近い場合はシークしない
+    デコードしたフレームは LRU キャッシュに入れる
+    """
+    # キーフレームが分からないとき、シークせずに順に読む最大フレーム数
+    SEQUENTIAL_READ_LIMIT = 30
+
+    def __init__(self, path: pathlib.Path, cache_bytes=256 * 1024 * 1024) -> None:
+        self.cv_video = cv2.VideoCapture(str(path))
+        self.frames_all = int(self.cv_video.get(cv2.CAP_PROP_FRAME_COUNT))
+        # 次に read() で得られるフレーム番号
+        self.position = 0
+        self.cache = FrameCache(cache_bytes)
+
+        # キーフレームの位置 (調べ終わるまでは None)
+        # ffprobe は全パケットを読むので UI スレッドを止めないよう別スレッドで実行する
+        self.keyframes = None
+        threading.Thread(target=self.analyze_keyframes, args=(path,), daemon=True).start()
+
+    def analyze_keyframes(self, path):
+        try:
+            self.keyframes = analyze_metadata.analyze_keyframes(path)
+        except FileNotFoundError:
+            print("ffprobe が見つからないため、キーフレームを使わずにシークします")
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print(f"キーフレームを調べられませんでした: {path.name}: {e}")
+
+    def isOpened(self):
+        return self.cv_video.isOpened()
+
+    def __len__(self):
+        return self.frames_all
+
+    def nearest_keyframe(self, index):
+        """
+        index 以前で最も近いキーフレーム (分からなければ None)
+        """
+        keyframes = self.keyframes
+        if not keyframes:
+            return None
+        i = bisect.bisect_right(keyframes, index)
+        return keyframes[i - 1] if i > 0 else 0
+
+    def read(self, index):
+        """
+        index 番目のフレームを返す (読めなければ None)
+        """
+        frame = self.cache.get(index)
+        if frame is not None:
+            return frame
+
+        keyframe = self.nearest_keyframe(index)
+        if keyframe is None:
+            # キーフレームが分からなければ、近い手前にいるときだけ順に読む
+            if not (index - self.SEQUENTIAL_READ_LIMIT <= self.position <= index):
+                self.cv_video.set(cv2.CAP_PROP_POS_FRAMES, index)
+                self.position = index
+        elif not (keyframe <= self.position <= index):
+            # 現在位置が同じ GOP 内の手前になければ、キーフレームからデコードする
+            self.cv_video.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            self.position = keyframe
+
+        while self.position <= index:
+            ret, frame = self.cv_video.read()
+            if not ret:
+                return None
+            self.cache.put(self.position, frame)
+            self.position += 1
+
+        return frame
+
+    def release(self):
+        self.cv_video.release()
+        self.cache.clear()
+
+class CropMovieFrameSource:
+    """
+    切り抜き結果 (SER / AVI(RAW)) をメモリマップでフレーム番号を指定して読み込む
+    """
+    def __init__(self, crop_movie) -> None:
+        self.crop_movie = crop_movie
+
+    def isOpened(self):
+        return True
+
+    def __len__(self):
+        return len(self.crop_movie)
+
+    def read(self, index):
+        if index >= len(self.crop_movie):
+            return None
+        frame = self.crop_movie[index]
+        # 16bit は表示用に 8bit にする
+        if frame.dtype == np.uint16:
+            frame = (frame >> 8).astype(np.uint8)
+        return frame
+
+    def release(self):
+        self.crop_movie.close()
+
+def open_frame_source(path: pathlib.Path):
+    """
+    プレビュー用に動画を開く
+    """
+    # 非圧縮の切り抜き結果はメモリマップで開く
+    crop_movie = my.open_crop_movie(path)
+    if crop_movie is not None:
+        return CropMovieFrameSource(crop_movie)
+    return VideoFrameSource(path)
+
+class PreviewProxy:
+    """
+    スライダー操作用の縮小グレースケール動画 (プロキシ) とサムネイル列
+
+    動画と同じディレクトリに "<ファイル名>.proxy.npy"(メモリマップ), ".proxy.json", ".thumbs.jpg" としてキャッシュし、
+    動画のファイルサイズ・更新日時が変わっていなければ再利用する
+    """
+    # プロキシの幅
+    WIDTH = 480
+    # プロキシに入れる最大フレーム数 (超える場合は間引く)
+    MAX_FRAMES = 1000
+    # サムネイルの枚数と幅
+    THUMBNAIL_COUNT = 10
+    THUMBNAIL_WIDTH = 96
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.frames_path = path.parent / (path.name + ".proxy.npy")
+        self.info_path = path.parent / (path.name + ".proxy.json")
+        self.thumbnail_path = path.parent / (path.name + ".thumbs.jpg")
+
+        self.is_ready = False
+        self.frames = None
+        self.step = 1
+        self.thumbnail_b64 = None
+
+    def file_key(self):
+        stat = self.path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def prepare(self):
+        """
+        キャッシュがあれば読み込み、なければ作る (バックグラウンドスレッドで呼ぶ)
+        """
+        try:
+            if not self.load():
+                self.build()
+                self.load()
+        except:
+            traceback.print_exc()
+
+    def load(self):
+        if not (self.info_path.exists() and self.frames_path.exists() and self.thumbnail_path.exists()):
+            return False
+
+        with open(str(self.info_path), "r") as f:
+            info = json.load(f)
+        if info.get("key") != self.file_key():
+            return False
+
+        self.step = info["step"]
+        self.frames = np.load(str(self.frames_path), mmap_mode="r")
+        self.thumbnail_b64 = base64.b64encode(self.thumbnail_path.read_bytes()).decode("ascii")
+        self.is_ready = True
+        return True
+
+    def build(self):
+        key = self.file_key()
+        cv_video = cv2.VideoCapture(str(self.path))
+        try:
+            frames_all = int(cv_video.get(cv2.CAP_PROP_FRAME_COUNT))
+            width = int(cv_video.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cv_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            if frames_all <= 0 or width <= 0:
+                return
+
+            step = max(1, -(-frames_all // self.MAX_FRAMES))
+            proxy_height = max(1, height * self.WIDTH // width)
+            count = -(-frames_all // step)
+
+            # 途中で止まっても壊れたキャッシュが残らないよう、一時ファイルに書いてから置き換える
+            tmp_path = self.frames_path.parent / (self.frames_path.stem + ".tmp.npy")
+            frames = np.lib.format.open_memmap(str(tmp_path), mode="w+", dtype=np.uint8, shape=(count, proxy_height, self.WIDTH))
+
+            # 先頭から順に1回だけデコードし、step 枚ごとに縮小して保存
+            written = 0
+            for index, frame in enumerate(my.read_frames(cv_video)):
+                if index % step != 0 or written >= count:
+                    continue
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                frames[written] = cv2.resize(gray, (self.WIDTH, proxy_height), interpolation=cv2.INTER_AREA)
+                written += 1
+
+            # フレーム数が申告より少なかった分は最後のフレームで埋める
+            if 0 < written < count:
+                frames[written:] = frames[written - 1]
+            frames.flush()
+            del frames
+            os.replace(str(tmp_path), str(self.frames_path))
+        finally:
+            cv_video.release()
+
+        # サムネイル列
+        frames = np.load(str(self.frames_path), mmap_mode="r")
+        thumbnail_height = max(1, proxy_height * self.THUMBNAIL_WIDTH // self.WIDTH)
+        thumbnails = []
+        for i in range(self.THUMBNAIL_COUNT):
+            frame = frames[i * (len(frames) - 1) // max(1, self.THUMBNAIL_COUNT - 1)]
+            thumbnails.append(cv2.resize(frame, (self.THUMBNAIL_WIDTH, thumbnail_height), interpolation=cv2.INTER_AREA))
+        _, encoded = cv2.imencode(".jpg", cv2.hconcat(thumbnails))
+        self.thumbnail_path.write_bytes(encoded.tobytes())
+
+        # 最後に情報ファイルを書く (これがあればキャッシュ完成)
+        with open(str(self.info_path), "w") as f:
+            json.dump({"key": key, "step": step, "frames_all": frames_all}, f)
+
+    def read(self, index):
+        """
+        index 番目のフレームに最も近い (手前の) プロキシのフレーム
+        """
+        return self.frames[min(len(self.frames) - 1, index // self.step)]
+
 class PreviewController():
+    # スライダーの連続したイベントをまとめる時間 [s]
+    DEBOUNCE_DELAY = 0.03
+    # スライダーが止まってから元解像度のフレームを読むまでの時間 [s]
+    FULL_FRAME_DELAY = 0.3
+    # エンコード済み画像のキャッシュ枚数
+    ENCODED_CACHE_SIZE = 256
+
     def __init__(self) -> None:
         
         self.is_open = False
         self.cv_img = CvImage()
+        # フレームの読み込み元と表示中のフレーム番号
+        self.frame_source = None
+        self.frame_index = 0
+        # スライダー操作用のプロキシ
+        self.proxy = None
+        # 保存済みの検出結果 (あれば枠表示に使う)
+        self.track = None
+
+        # 描画はワーカースレッドで行い、要求は最新の1件だけ残す
+        self.render_cond = threading.Condition()
+        self.render_request = None
+        # 描画中に動画を閉じないためのロック
+        self.render_lock = threading.Lock()
+        # エンコード済み画像のキャッシュ
+        self.encoded_cache = collections.OrderedDict()
+        self.render_thread = threading.Thread(target=self.render_worker, daemon=True)
+        self.render_thread.start()
         
         # 表示領域
         self.image_control = ft.Image(
             src_base64=self.cv_img.get_nodata_b64_image(),
-            width=960,
+            width=PREVIEW_WIDTH,
             fit=ft.ImageFit.SCALE_DOWN,
         )
 
+        # サムネイル列
+        self.thumbnail_control = ft.Image(
+            src_base64=self.cv_img.get_nodata_b64_image(),
+            width=PREVIEW_WIDTH,
+            fit=ft.ImageFit.FILL,
+            visible=False,
+        )
+
         # スライドバー
         self.slider_control = ft.Slider(
             disabled=True,
@@ -85,72 +397,176 @@ class PreviewController():
         self.close_movie()
         self.opend_file_text.value = ""
 
-    def open_movie(self, path):
+    def open_movie(self, path, proxy: PreviewProxy = None):
         if self.is_open:
             self.close_movie()
         
         # ファイルオープン
-        self.cv_video = cv2.VideoCapture(str(path))
-        if self.cv_video.isOpened():
-            self.is_open = True
-        else:
-            self.is_open = False
-            return
+        with self.render_lock:
+            self.frame_source = open_frame_source(pathlib.Path(path))
+            self.frame_index = 0
+            self.proxy = proxy
+            self.track = my.DetectionTrack.load(pathlib.Path(path))
+            self.encoded_cache.clear()
+            if self.frame_source.isOpened():
+                self.is_open = True
+            else:
+                self.frame_source.release()
+                self.is_open = False
+                return
         
         # 表示
-        self.display_current_cv_image()
+        self.request_render(self.frame_index)
 
         # スライダー
         self.enable_slider()
+        self.update_thumbnail()
 
         self.opend_file_text.value = str(path)
         self.opend_file_text.update()
 
     def close_movie(self):
         if self.is_open:
-            self.cv_video.release()
+            with self.render_lock:
+                self.is_open = False
+                self.frame_source.release()
+                self.frame_source = None
+                self.proxy = None
+                self.track = None
+                self.encoded_cache.clear()
+            self.update_thumbnail()
             self.disable_slider()
             self.image_control.src_base64 = self.cv_img.get_nodata_b64_image()
-            self.is_open = False
+            self.image_control.update()
             self.opend_file_text.value = ""
             self.opend_file_text.update()
 
-    def display_current_cv_image(self):
+    def box_setting(self):
+        """
+        切り抜き枠の表示設定 (表示しなければ None)
+        """
+        if self.box_display_switch.value and self.box_size_dd.value is not None:
+            return int(self.box_size_dd.value)
+        return None
+
+    def render_cv_image(self, index, use_proxy):
+        """
+        index 番目のフレームを表示用の base64 画像にする
+        use_proxy が True ならプロキシのフレームを使う
+        """
+        crop_size = self.box_setting()
+        key = (index, use_proxy, crop_size)
+        b64_img = self.encoded_cache.get(key)
+        if b64_img is not None:
+            self.encoded_cache.move_to_end(key)
+            return b64_img
+
         # フレーム取得
-        ret, cv_frame = self.cv_video.read()
-        if not ret:
-            cv_frame = self.cv_img.get_nodata_cv_image()
-        
-        # スイッチで切り替え
-        # print(self.box_display_switch.value)
-        # print(self.box_size_dd.value)
-        if self.box_display_switch.value and self.box_size_dd is not None:
+        if use_proxy:
+            cv_frame = self.proxy.read(index)
+        else:
+            cv_frame = self.frame_source.read(index)
+            if cv_frame is None:
+                cv_frame = self.cv_img.get_nodata_cv_image()
 
+        # スイッチで切り替え
+        if crop_size is not None and not use_proxy:
+            cv_frame = self.draw_crop_box(cv_frame, crop_size, index)
+
+        b64_img = self.cv_img.cv_to_b64_image(cv_frame, PREVIEW_WIDTH)
+        self.encoded_cache[key] = b64_img
+        while len(self.encoded_cache) > self.ENCODED_CACHE_SIZE:
+            self.encoded_cache.popitem(last=False)
+        return b64_img
+
+    def draw_crop_box(self, cv_frame, crop_size, index):
+        if self.track is not None:
+            # 保存済みの検出結果を使い、元のフレームに枠を描く
+            detection = self.track.lookup(index)
+            if not detection.present:
+                return cv_frame
+            x, y = detection.x, detection.y
+            img = cv_frame.copy()
+        else:
             # 前処理
             img = my.preprocess(cv_frame)
             # 惑星写ってなかったら1回おやすみ
-            if my.exists_planets(img):
-                # 重心計算
-                x, y = my.calc_moment(img)
+            if not my.exists_planets(img):
+                return cv_frame
 
-                # 切り出しサイズ決定
-                width = int(self.cv_video.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(self.cv_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                crop_size = int(self.box_size_dd.value)
-                x1, x2, y1, y2 = my.calc_crop_range(width, height, x, y, crop_size)
+            # 重心計算
+            x, y = my.calc_moment(img)
 
-                # 線を描画
-                cv2.rectangle(img, (x1, y1), (x2, y2), (255, 255, 255))
-                cv_frame = img
+        # 切り出しサイズ決定
+        height, width = cv_frame.shape[:2]
+        x1, x2, y1, y2 = my.calc_crop_range(width, height, x, y, crop_size)
 
-        # 画像表示
-        self.set_cv_image(cv_frame)
+        # 線を描画 (縮小表示で消えないよう太さを合わせる)
+        thickness = max(1, round(width / PREVIEW_WIDTH))
+        cv2.rectangle(img, (x1, y1), (x2, y2), (255, 255, 255), thickness)
+        return img
+
+    def display_current_cv_image(self):
+        self.request_render(self.frame_index)
 
-    def set_cv_image(self, cv_img):
-        b64_img = self.cv_img.cv_to_b64_image(cv_img)
+    def set_b64_image(self, b64_img):
         self.image_control.src_base64 = b64_img
         self.image_control.update()
 
+    def request_render(self, index):
+        """
+        描画を要求する (まだ描画していない古い要求は捨てる)
+        """
+        with self.render_cond:
+            self.render_request = index
+            self.render_cond.notify()
+
+    def wait_render_request(self, timeout=None):
+        """
+        次の描画要求を待って取り出す (timeout までに来なければ None)
+        """
+        with self.render_cond:
+            if self.render_request is None:
+                self.render_cond.wait(timeout)
+            index = self.render_request
+            self.render_request = None
+            return index
+
+    def render_worker(self):
+        index = None
+        while True:
+            if index is None:
+                index = self.wait_render_request()
+
+            # 連続したイベントをまとめ、その間の最新の要求だけ描画する
+            time.sleep(self.DEBOUNCE_DELAY)
+            newer = self.wait_render_request(0)
+            if newer is not None:
+                index = newer
+
+            try:
+                use_proxy = self.proxy is not None and self.proxy.is_ready
+                self.render(index, use_proxy)
+
+                # 操作中はプロキシを表示し、スライダーが止まってから元解像度を読む
+                if use_proxy:
+                    newer = self.wait_render_request(self.FULL_FRAME_DELAY)
+                    if newer is not None:
+                        index = newer
+                        continue
+                    self.render(index, False)
+            except:
+                traceback.print_exc()
+
+            index = None
+
+    def render(self, index, use_proxy):
+        with self.render_lock:
+            if not self.is_open:
+                return
+            b64_img = self.render_cv_image(index, use_proxy)
+        self.set_b64_image(b64_img)
+
     def enable_slider(self):
         self.slider_control.disabled = False
         self.slider_control.value = 0
@@ -160,17 +576,25 @@ class PreviewController():
         self.slider_control.disabled = True
         self.slider_control.update()
 
+    def update_thumbnail(self):
+        if self.proxy is not None and self.proxy.is_ready:
+            self.thumbnail_control.src_base64 = self.proxy.thumbnail_b64
+            self.thumbnail_control.visible = True
+        else:
+            self.thumbnail_control.visible = False
+        self.thumbnail_control.update()
+
     def on_slider_change(self, e):
         if self.is_open:
             self.seek_cv_video(self.slider_control.value)
             # print(self.slider_control.value)
 
     def seek_cv_video(self, value):
-        frames_all = int(self.cv_video.get(cv2.CAP_PROP_FRAME_COUNT))
+        frames_all = len(self.frame_source)
         
         seek = int(value * (frames_all - 1))
         seek = max(0, min(frames_all-1, seek))
-        self.cv_video.set(cv2.CAP_PROP_FRAME_COUNT, seek)
+        self.frame_index = seek
         # print(seek)
     
         self.display_current_cv_image()
@@ -189,17 +613,21 @@ class FileListController:
         )
 
         self.file_list: list[FileListRecord] = list()
+        # プレビュー用プロキシをバックグラウンドで1つずつ作る
+        self.proxy_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     
     def on_file_list_record_preview_clicked(self, e):
         record = self.find_preview_record(e.control)
-        self.main_con.preview_control.open_movie(record.path)
+        self.main_con.preview_control.open_movie(record.path, record.proxy)
 
     def on_file_list_record_delete_clicked(self, e):
         record = self.find_delete_record(e.control)
         self.remove_record(record)
         
     def add_record(self, name: str, path: pathlib.Path()):
-        self.file_list.append(FileListRecord(self, name, path))
+        record = FileListRecord(self, name, path)
+        self.file_list.append(record)
+        self.proxy_executor.submit(record.proxy.prepare)
     
     def remove_record(self, record):
         self.file_list.remove(record)
@@ -229,6 +657,8 @@ class FileListRecord:
         self.controller = controller
         self.name = name
         self.path = path
+        # プレビュー用プロキシ
+        self.proxy = PreviewProxy(path)
 
         # 処理状況
         self.status: RecordStatus = RecordStatus.UNPROCESSED
@@ -294,26 +724,61 @@ class MainController:
             self.execute_status.value = "処理中"
 
             try:
-                for record in self.file_list_con.file_list:
-                    if record.status is RecordStatus.UNPROCESSED:
-                        record.update_status(RecordStatus.PROCESSING)
-                        self.execute_status.value = record.status.ja
-                        self.page.update()
-                        
-                        crop_size = record.get_crop_size()
-                        my.main_cropping(record.path, crop_size)
+                records = [record for record in self.file_list_con.file_list if record.status is RecordStatus.UNPROCESSED]
+                for record in records:
+                    record.update_status(RecordStatus.PROCESSING)
+                self.page.update()
 
+                jobs = [(record.path, record.get_crop_size()) for record in records]
+                done_count = 0
+                written_count = 0
+                # 処理中のジョブの進捗 (index -> 集計)
+                progress = dict()
+
+                def show_progress():
+                    text = "処理中 %d/%d" % (done_count, len(jobs))
+                    for index, summary in sorted(progress.items()):
+                        elapsed = summary["elapsed"]
+                        text += "\n%s: %d/%d フレーム (%.1f fps, 惑星なし %d)" % (
+                            records[index].name, summary["frames_done"], summary["frames_all"],
+                            summary["frames_read"] / elapsed if elapsed > 0 else 0, summary["frames_no_planet"])
+                    self.execute_status.value = text
+                    self.page.update()
+
+                def on_progress(index, infile_path, summary):
+                    progress[index] = summary
+                    show_progress()
+
+                def on_job_done(index, infile_path, error, summary):
+                    nonlocal done_count, written_count
+                    done_count += 1
+                    progress.pop(index, None)
+
+                    record = records[index]
+                    if error is None:
                         record.update_status(RecordStatus.PROCESSED)
-                        self.execute_status.value = record.status.ja
-                        self.page.update()
-                        
-                self.execute_status.value = "完了"
+                        written_count += summary["frames_written"]
+                        print(my.format_crop_summary(summary))
+                    else:
+                        print("error:", infile_path, repr(error))
+                        record.update_status(RecordStatus.ERROR)
+                    show_progress()
+
+                # プロセスプールで並列処理
+                errors = my.batch_cropping(jobs, on_job_done=on_job_done, on_progress=on_progress, threaded=True)
+
+                if len(errors) == 0:
+                    self.execute_status.value = "完了 (%d フレーム書き出し)" % (written_count)
+                else:
+                    self.execute_status.value = "完了 (エラー %d件, %d フレーム書き出し)" % (len(errors), written_count)
                 self.page.update()
 
             except:
                 traceback.print_exc()
                 self.execute_status.value = "エラー"
                 self.page.update()
+
+            finally:
                 self.is_processing = False
 
     
@@ -363,6 +828,7 @@ class MainController:
             ]),
             ft.Column([
                 self.preview_control.image_control,
+                self.preview_control.thumbnail_control,
                 self.preview_control.slider_control,
             ]),
             ft.Row([
@@ -376,5 +842,7 @@ class MainController:
         )
 
 if __name__ == "__main__":
+    # exe 化したときにワーカープロセスが GUI を起動しないようにする
+    multiprocessing.freeze_support()
     controller = MainController()
     ft.app(target=controller.main)
@@ -0,0 +1,232 @@
+"""
+SER 形式の動画ファイル
+
+惑星撮影で使われる非圧縮の動画形式
+ヘッダ(178 byte) + フレームデータ(固定長) + タイムスタンプ(8 byte x フレーム数) で構成される
+http://www.grischa-hahn.homepage.t-online.de/astro/ser/
+"""
+
+# 公式
+import datetime
+import pathlib
+import struct
+
+# サードパーティ
+import cv2
+import numpy as np
+
+# ヘッダ
+SER_FILE_ID = b"LUCAM-RECORDER"
+SER_HEADER_FORMAT = "<14s7i40s40s40sqq"
+SER_HEADER_SIZE = struct.calcsize(SER_HEADER_FORMAT)
+# ヘッダ内の FrameCount の位置
+SER_FRAME_COUNT_OFFSET = 38
+
+# ColorID
+SER_COLOR_MONO = 0
+SER_COLOR_RGB = 100
+SER_COLOR_BGR = 101
+
+# 出力モード: (ColorID, チャンネル数, 1プレーンあたりのビット数)
+# カラーは OpenCV のバッファをそのまま書けるように BGR 順で保存する
+SER_MODES = {
+    "mono8": (SER_COLOR_MONO, 1, 8),
+    "mono16": (SER_COLOR_MONO, 1, 16),
+    "rgb8": (SER_COLOR_BGR, 3, 8),
+    "rgb16": (SER_COLOR_BGR, 3, 16),
+}
+
+# タイムスタンプの基準 (0001-01-01 00:00:00 UTC からの 100ns 単位)
+SER_EPOCH = datetime.datetime(1, 1, 1, tzinfo=datetime.timezone.utc)
+
+def to_ser_timestamp(dt: datetime.datetime) -> int:
+    """
+    datetime を SER のタイムスタンプに変換する
+    タイムゾーンなしの datetime はローカル時間とみなす
+    """
+    if dt.tzinfo is None:
+        dt = dt.astimezone()
+    return (dt - SER_EPOCH) // datetime.timedelta(microseconds=1) * 10
+
+def from_ser_timestamp(ticks: int) -> datetime.datetime:
+    """
+    SER のタイムスタンプを UTC の datetime に変換する
+    """
+    return SER_EPOCH + datetime.timedelta(microseconds=ticks // 10)
+
+class SerWriter:
+    """
+    SER ファイルを書き出す
+
+    フレームは確保済みのバッファに変換・コピーしてから、そのままファイルに書き込む
+    FrameCount とタイムスタンプは release() で書き込む
+    """
+    def __init__(self, path: pathlib.Path, width, height, mode="mono8", start_time=None,
+                 observer="", instrument="", telescope="") -> None:
+        if mode not in SER_MODES:
+            raise ValueError("unknown ser mode: %s" % mode)
+
+        self.path = path
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.color_id, self.channels, self.depth = SER_MODES[mode]
+        self.observer = observer
+        self.instrument = instrument
+        self.telescope = telescope
+
+        if start_time is None:
+            start_time = datetime.datetime.now().astimezone()
+        self.start_time = start_time
+
+        # 書き込み用バッファ
+        shape = (height, width) if self.channels == 1 else (height, width, self.channels)
+        self.buffer8 = np.empty(shape, np.uint8)
+        self.buffer16 = np.empty(shape, np.uint16) if self.depth == 16 else None
+
+        self.frame_count = 0
+        self.timestamps = []
+
+        self.file = open(str(path), "wb")
+        self.file.write(self.pack_header())
+
+    def pack_header(self):
+        local_time = self.start_time.astimezone()
+        local_ticks = to_ser_timestamp(local_time.replace(tzinfo=datetime.timezone.utc))
+        return struct.pack(
+            SER_HEADER_FORMAT,
+            SER_FILE_ID,
+            0,                  # LuID
+            self.color_id,
+            0,                  # LittleEndian (多くのソフトウェアの慣例に合わせ、リトルエンディアンでも 0)
+            self.width,
+            self.height,
+            self.depth,
+            self.frame_count,
+            self.observer.encode("ascii", "replace"),
+            self.instrument.encode("ascii", "replace"),
+            self.telescope.encode("ascii", "replace"),
+            local_ticks,
+            to_ser_timestamp(self.start_time),
+        )
+
+    def isOpened(self):
+        return not self.file.closed
+
+    def convert(self, img):
+        """
+        img を書き込み用バッファに変換して返す
+        """
+        buffer8 = self.buffer8
+        if self.channels == 1:
+            if img.ndim == 3:
+                cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=buffer8)
+            else:
+                np.copyto(buffer8, img)
+        else:
+            if img.ndim == 2:
+                cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, dst=buffer8)
+            else:
+                np.copyto(buffer8, img)
+
+        if self.depth == 8:
+            return buffer8
+
+        # 8bit -> 16bit (0..255 を 0..65535 に広げる)
+        np.multiply(buffer8, np.uint16(257), out=self.buffer16)
+        return self.buffer16
+
+    def write(self, img, timestamp=None):
+        """
+        1フレーム書き込む
+        timestamp はフレームの撮影時刻 (None なら開始時刻)
+        """
+        buffer = self.convert(img)
+        self.file.write(buffer.data)
+
+        if timestamp is None:
+            timestamp = self.start_time
+        self.timestamps.append(to_ser_timestamp(timestamp))
+        self.frame_count += 1
+
+    def write_raw(self, data, ticks):
+        """
+        SER のフレームデータ (同じ画素形式の SerReader[i] など) を変換せずに1フレーム書き込む
+        ticks は SER のタイムスタンプ
+        """
+        self.file.write(np.ascontiguousarray(data).data)
+        self.timestamps.append(int(ticks))
+        self.frame_count += 1
+
+    def release(self):
+        if self.file.closed:
+            return
+
+        # タイムスタンプ
+        self.file.write(np.array(self.timestamps, dtype="<u8").tobytes())
+
+        # フレーム数
+        self.file.seek(SER_FRAME_COUNT_OFFSET)
+        self.file.write(struct.pack("<i", self.frame_count))
+        self.file.close()
+
+class SerReader:
+    """
+    SER ファイルをメモリマップで読み込む
+
+    frames はファイル上のフレームデータをそのまま参照する (フレーム数, 高さ, 幅[, チャンネル]) の配列
+    reader[i] で i 番目のフレームをコピーなしで取得できる
+    """
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+
+        with open(str(path), "rb") as f:
+            header = struct.unpack(SER_HEADER_FORMAT, f.read(SER_HEADER_SIZE))
+        (file_id, lu_id, self.color_id, little_endian, self.width, self.height,
+         self.depth, frame_count, observer, instrument, telescope, date_time, date_time_utc) = header
+        if file_id != SER_FILE_ID:
+            raise ValueError("not a ser file: %s" % path)
+
+        self.start_time = from_ser_timestamp(date_time_utc)
+        # 撮影時のローカル時間 (タイムゾーンなし)
+        self.local_start_time = from_ser_timestamp(date_time).replace(tzinfo=None)
+        self.channels = 1 if self.color_id < SER_COLOR_RGB else 3
+
+        # 16bit はリトルエンディアンとして読む (書き出し側の慣例に合わせる)
+        dtype = np.dtype(np.uint8) if self.depth <= 8 else np.dtype("<u2")
+        shape = (self.height, self.width) if self.channels == 1 else (self.height, self.width, self.channels)
+        frame_size = int(np.prod(shape)) * dtype.itemsize
+
+        self.mmap = np.memmap(str(path), dtype=np.uint8, mode="r")
+
+        # 書き込み途中などで FrameCount が実際より多い場合に備える
+        frame_count = min(frame_count, (self.mmap.size - SER_HEADER_SIZE) // frame_size)
+        data_end = SER_HEADER_SIZE + frame_count * frame_size
+        self.frames = self.mmap[SER_HEADER_SIZE : data_end].view(dtype).reshape((frame_count,) + shape)
+
+        # タイムスタンプ (ない場合は空)
+        trailer = self.mmap[data_end : data_end + frame_count * 8]
+        if trailer.size == frame_count * 8:
+            self.timestamps = trailer.view("<u8")
+        else:
+            self.timestamps = np.empty(0, dtype="<u8")
+
+    @property
+    def fps(self):
+        """
+        タイムスタンプから求めたフレームレート (不明なら 0)
+        """
+        if len(self.timestamps) < 2 or self.timestamps[-1] <= self.timestamps[0]:
+            return 0.0
+        return (len(self.timestamps) - 1) / ((int(self.timestamps[-1]) - int(self.timestamps[0])) / 10 ** 7)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def close(self):
+        self.frames = None
+        self.timestamps = None
+        self.mmap = None